@@ -0,0 +1,499 @@
+from datetime import datetime
+from os import makedirs, stat
+from os.path import abspath, dirname, join
+from random import Random
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+from typing import List
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tracemalloc
+
+import WordGame
+from WordGame import Line, SideChoice
+
+
+############################# Synthetic decks
+
+
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+
+def random_word(rng: Random, length: int) -> str:
+    return ''.join(rng.choice(LETTERS) for _ in range(max(1, length)))
+
+
+def generate_deck_lines(line_count: int, line_length: int = 24,
+                        comment_density: float = 0.1,
+                        multi_line_comment_density: float = 0.01,
+                        seed: int = 0) -> List[str]:
+    # line_count raw lines of roughly line_length characters. comment_density
+    # of them end with a # comment and multi_line_comment_density of them
+    # open a three line """ block.
+    rng = Random(seed)
+    side_length = max(1, (line_length - 3) // 2)
+    raw_lines = []
+    while len(raw_lines) < line_count:
+        if rng.random() < multi_line_comment_density:
+            raw_lines.append(f'"""{random_word(rng, side_length)}\n')
+            raw_lines.append(f"{random_word(rng, side_length)} - {random_word(rng, side_length)}\n")
+            raw_lines.append('"""\n')
+            continue
+        line = f"{random_word(rng, side_length)} - {random_word(rng, side_length)}"
+        if rng.random() < comment_density:
+            line += f" # {random_word(rng, side_length)}"
+        raw_lines.append(line + "\n")
+    return raw_lines[:line_count]
+
+
+def write_deck_files(directory: str, raw_lines: List[str], lines_per_file: int = 1000):
+    for file_number, start in enumerate(range(0, len(raw_lines), lines_per_file)):
+        with open(join(directory, f"deck_{file_number:06}.txt"), 'w', encoding='utf-8') as f:
+            f.writelines(raw_lines[start:start + lines_per_file])
+
+
+def make_line_store(line_count: int) -> WordGame.LineStore:
+    line_store = WordGame.LineStore()
+    line_store.extend_packed(WordGame.pack_line_records(
+        WordGame.iter_line_records(generate_deck_lines(line_count,
+                                                       multi_line_comment_density=0))))
+    return line_store
+
+
+############################# Timing
+
+
+def best_of(func, repeat: int = 3) -> float:
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+############################# Parser
+
+
+# The parser as it was before iter_line_list, kept for side-by-side timings
+def legacy_raw_lines_to_line_list(raw_lines: List[str],
+blacklist = [], comment = "#", multi_line_comment = '"""',
+split_ = " - ", side = SideChoice.RANDOM) -> List[Line]:
+    lines = list()
+    inside_ml_com = False
+    for index, line in enumerate(raw_lines, start=1):
+        if index not in blacklist:
+
+            to_remove = None
+            while multi_line_comment in line:
+                start_index = line.find(multi_line_comment)
+
+                if inside_ml_com:
+                    to_remove = line[:start_index + len(multi_line_comment)]
+                    inside_ml_com = False
+                elif (end_index := line.find(multi_line_comment,
+                start_index + len(multi_line_comment))) != -1:
+                    to_remove = line[start_index:end_index + len(multi_line_comment)]
+                else:
+                    to_remove = line[start_index:]
+                    inside_ml_com = True
+
+                if to_remove is not None:
+                    line = line.replace(to_remove, '', 1)
+                    to_remove = None
+
+            if comment in line:
+                line = line[:line.index(comment)]
+
+            if split_ in line:
+                left, right = line.strip().split(split_)
+                append_line = Line(left, right, side)
+                append_line.index = index
+                lines.append(append_line)
+    return lines
+
+
+def bench_parser(line_count: int) -> dict:
+    raw_lines = generate_deck_lines(line_count)
+    blacklist = list(range(1, line_count, 100))
+    return {
+        "legacy_s": best_of(lambda: legacy_raw_lines_to_line_list(raw_lines, blacklist)),
+        "streaming_s": best_of(lambda: WordGame.raw_lines_to_line_list(raw_lines, blacklist)),
+    }
+
+
+############################# Engine
+
+
+def make_lines(line_count: int) -> List[Line]:
+    lines = []
+    for i in range(line_count):
+        line = Line(f"word{i}", f"slowo{i}", SideChoice.LEFT)
+        line.index = i + 1
+        lines.append(line)
+    return lines
+
+
+def bench_engine(line_count: int, answers: int = 10000) -> dict:
+    settings = dict(WordGame.DEFAULT_GAME_SETTINGS, only_once=False)
+    game_data = WordGame.get_default_game_data()
+    game_data["settings"] = settings
+    game_data["remaining_lines"] = make_lines(line_count)
+    engine = WordGame.GameEngine(game_data)
+
+    # Every answer is a mistake, so each one advances and requeues and the
+    # queue keeps its size for the whole run
+    start = perf_counter()
+    for _ in range(answers):
+        engine.progress_game_simple_mode("x")
+    elapsed = perf_counter() - start
+    return {"answers": answers, "per_answer_us": elapsed / answers * 10**6}
+
+
+def time_answers(line_count: int, settings: dict, answer, answers: int) -> dict:
+    line_store = make_line_store(line_count)
+    if settings["typing_mode"]:
+        line_store.prepare_answers(WordGame.answer_normalization(settings))
+    game_data = WordGame.get_default_game_data()
+    game_data["settings"] = settings
+    game_data["remaining_lines"] = line_store
+    engine = WordGame.GameEngine(game_data)
+
+    answers = min(answers, line_count)
+    progress = engine.progress_game_typing_mode if settings["typing_mode"] \
+        else engine.progress_game_simple_mode
+    start = perf_counter()
+    for i in range(answers):
+        progress(answer(engine, i))
+    elapsed = perf_counter() - start
+    return {"answers": answers, "per_answer_us": elapsed / answers * 10**6}
+
+
+def bench_typing_mode(line_count: int, answers: int = 10000) -> dict:
+    settings = dict(WordGame.DEFAULT_GAME_SETTINGS, typing_mode=True,
+                    only_once=False, typo_tolerance=1)
+
+    # Two thirds right, one third with a typo to exercise the fuzzy check
+    def answer(engine, i):
+        line = engine.get_curent_line()
+        text = line.side_as_string(line.side_answer, False)
+        return text if i % 3 else text[:-1]
+
+    return time_answers(line_count, settings, answer, answers)
+
+
+def bench_simple_mode(line_count: int, answers: int = 10000) -> dict:
+    settings = dict(WordGame.DEFAULT_GAME_SETTINGS, only_once=False)
+    return time_answers(line_count, settings,
+                        lambda engine, i: "" if i % 3 else "x", answers)
+
+
+############################# Loading
+
+
+def bench_load_files(line_count: int) -> dict:
+    raw_lines = generate_deck_lines(line_count)
+    with TemporaryDirectory() as directory:
+        deck_directory = join(directory, "decks")
+        makedirs(deck_directory)
+        write_deck_files(deck_directory, raw_lines)
+        cache = WordGame.DeckCache(join(directory, "deck_cache.bin"))
+
+        def cold():
+            cache.clear()
+            WordGame.load_files_on_dir(deck_directory, cache=cache)
+
+        def warm():
+            WordGame.load_files_on_dir(deck_directory, cache=cache)
+
+        return {
+            "files": -(-line_count // 1000),
+            "no_cache_s": best_of(lambda: WordGame.load_files_on_dir(deck_directory)),
+            "cold_cache_s": best_of(cold),
+            "warm_cache_s": best_of(warm),
+        }
+
+
+############################# Batching
+
+
+def bench_batches(line_count: int, batch_size: int = 5) -> dict:
+    line_ids = WordGame.permuted(range(line_count))
+    start = perf_counter()
+    batches = WordGame.divide_into_batches(line_ids, batch_size)
+    divide_s = perf_counter() - start
+    start = perf_counter()
+    for batch in batches:
+        pass
+    return {"batches": len(batches), "divide_s": divide_s,
+            "iterate_s": perf_counter() - start}
+
+
+############################# Multiple choice
+
+
+def bench_distractors(line_count: int, picks: int = 10000) -> dict:
+    line_store = make_line_store(line_count)
+    index = WordGame.DistractorIndex()
+    start = perf_counter()
+    index.add(line_store, range(line_count))
+    build_s = perf_counter() - start
+
+    rng = Random(0)
+    ids = [rng.randrange(line_count) for _ in range(picks)]
+    start = perf_counter()
+    for id in ids:
+        index.options(line_store, id, SideChoice.RIGHT, 3, rng=rng)
+    return {"build_s": build_s,
+            "per_pick_us": (perf_counter() - start) / picks * 10**6}
+
+
+############################# Prompts
+
+
+def bench_prompts(line_count: int, turns: int = 500, think_s: float = 0.001) -> dict:
+    # Time the game loop waits for the next prompt in multiple choice mode,
+    # with the player taking think_s to answer every line
+    line_store = make_line_store(line_count)
+    settings = dict(WordGame.DEFAULT_GAME_SETTINGS, multiple_choice=True, only_once=False)
+    WordGame.distractor_index(line_store)
+    results = {}
+    for depth in (0, 4):
+        game_data = dict(WordGame.GAME_DATA, settings=settings, line_store=line_store,
+                         remaining_lines=range(line_count))
+        engine = WordGame.GameEngine(game_data)
+        prompts = WordGame.PromptPipeline(depth)
+        waited = 0
+        for turn in range(turns):
+            start = perf_counter()
+            prompt = prompts.next(engine)
+            waited += perf_counter() - start
+            prompts.prefetch(engine)
+            sleep(think_s)
+            engine.progress_game_choice_mode(prompt.options[turn % len(prompt.options)])
+        prompts.close()
+        results[f"depth_{depth}_wait_us"] = waited / turns * 10**6
+    return results
+
+
+############################# Persistence
+
+
+def bench_saves(line_count: int) -> dict:
+    line_store = make_line_store(line_count)
+    game_data = WordGame.get_default_game_data()
+    game_data["remaining_lines"] = list(range(line_count))
+    game_data["line_store"] = line_store
+
+    # The same game exported as json, the format saves had before, and in
+    # the binary save format
+    results = {}
+    with TemporaryDirectory() as directory:
+        for name, file_name in (("json", "game_saves.json"), ("binary", "game_saves.sav")):
+            file_path = join(directory, file_name)
+            results[f"{name}_save_s"] = best_of(
+                lambda: WordGame.save_game_data_list([game_data], file_path))
+            results[f"{name}_load_s"] = best_of(
+                lambda: WordGame.load_game_data_list(file_path))
+            results[f"{name}_bytes"] = stat(file_path).st_size
+
+        # A game on a compiled deck only saves the deck path and its ids
+        deck_path = join(directory, "deck.wgd")
+        WordGame.compile_deck(line_store, deck_path)
+        game_data = dict(game_data, line_store=WordGame.MappedDeck(deck_path))
+        file_path = join(directory, "compiled_saves.sav")
+        results["compiled_save_s"] = best_of(
+            lambda: WordGame.save_game_data_list([game_data], file_path))
+        results["compiled_load_s"] = best_of(
+            lambda: WordGame.load_game_data_list(file_path))
+        results["compiled_bytes"] = stat(file_path).st_size
+
+        # What an autosave costs the turn it is taken on, the packing is
+        # left to the autosave thread
+        for name, lines in (("store", line_store), ("compiled", game_data["line_store"])):
+            game_master = WordGame.GameMaster(None)
+            game_master.new_game(lines, WordGame.get_default_game_data()["settings"],
+                                 None, range(line_count))
+            results[f"{name}_snapshot_s"] = best_of(lambda: WordGame._save_parts(
+                game_master.game_engine.extract_game_data_from_self()))
+    return results
+
+
+############################# History
+
+
+def bench_line_stats(line_count: int, games: int = 5) -> dict:
+    # games finished games over the whole deck with a mistake on every
+    # seventh answer of the line, then the hardest lines found both ways
+    line_store = make_line_store(line_count)
+    settings = dict(WordGame.DEFAULT_GAME_SETTINGS, only_once=True)
+    with TemporaryDirectory() as directory:
+        history = WordGame.GameHistory(join(directory, "game_history.db"))
+        for game in range(games):
+            game_data = dict(WordGame.GAME_DATA, settings=settings, line_store=line_store,
+                             remaining_lines=range(line_count))
+            engine = WordGame.GameEngine(game_data)
+            for i in range(line_count):
+                engine.progress_game_simple_mode("x" if (i + game) % 7 == 0 else "")
+            history.record_game(engine, line_count, "decks")
+
+        line_stats = WordGame.LineStats(history)
+        start = perf_counter()
+        line_stats.update()
+        update_s = perf_counter() - start
+        results = {
+            "rows": line_count * games,
+            "update_s": update_s,
+            "hardest_s": best_of(lambda: line_stats.hardest(50)),
+            "sql_hardest_s": best_of(lambda: history.hardest_lines(50)),
+            "trend_s": best_of(line_stats.score_trend),
+        }
+        history.close()
+        return results
+
+
+############################# Memory
+
+
+# Line as it was before __slots__ and LineStore
+class LegacyLine:
+    def __init__(self, left: str, right: str, side_answer: SideChoice = SideChoice.RANDOM):
+        self.left = left
+        self.right = right
+        self.side_answer = WordGame.side_random_handle(side_answer)
+        self.index: int = None
+
+
+def traced_peak(build) -> int:
+    tracemalloc.start()
+    kept = build()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return peak
+
+
+def bench_memory(line_count: int) -> dict:
+    raw_lines = generate_deck_lines(line_count)
+    payload = WordGame.pack_line_records(WordGame.iter_line_records(raw_lines))
+
+    def build_legacy():
+        lines = []
+        for index, left, right in WordGame.iter_line_records(raw_lines):
+            legacy_line = LegacyLine(left, right)
+            legacy_line.index = index
+            lines.append(legacy_line)
+        return lines
+
+    def build_slots():
+        return WordGame.raw_lines_to_line_list(raw_lines)
+
+    def build_store():
+        line_store = WordGame.LineStore()
+        line_store.extend_packed(payload)
+        return line_store
+
+    return {
+        "legacy_bytes": traced_peak(build_legacy),
+        "slots_bytes": traced_peak(build_slots),
+        "line_store_bytes": traced_peak(build_store),
+    }
+
+
+############################# Startup
+
+
+IMPORT_TIMING = """
+import sys
+from time import perf_counter, sleep
+sys.path.insert(0, {path!r})
+start = perf_counter()
+import WordGame
+{after}
+print(perf_counter() - start)
+"""
+
+
+def time_import(after: str = "", repeat: int = 5) -> float:
+    # Best wall time of importing WordGame in a fresh interpreter, started in
+    # an empty directory every time so there are no settings to find
+    code = IMPORT_TIMING.format(path=dirname(abspath(WordGame.__file__)), after=after)
+    best = None
+    for _ in range(repeat):
+        with TemporaryDirectory() as directory:
+            output = subprocess.run([sys.executable, "-c", code], cwd=directory,
+                                    capture_output=True, text=True, check=True).stdout
+        elapsed = float(output)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_import(line_count: int) -> dict:
+    # line_count is unused, importing does not depend on a deck
+    return {
+        "lazy_s": time_import(),
+        # Everything the import used to do up front
+        "eager_s": time_import("WordGame.context.settings\n"
+                               "WordGame.context.game_history.count_games()\n"
+                               "import asyncio"),
+    }
+
+
+############################# Runner
+
+
+BENCHMARKS = {
+    "parser": bench_parser,
+    "load_files": bench_load_files,
+    "engine": bench_engine,
+    "typing_mode": bench_typing_mode,
+    "simple_mode": bench_simple_mode,
+    "batches": bench_batches,
+    "distractors": bench_distractors,
+    "prompts": bench_prompts,
+    "saves": bench_saves,
+    "line_stats": bench_line_stats,
+    "memory": bench_memory,
+    "import": bench_import,
+}
+
+
+def run_benchmarks(names: List[str], sizes: List[int]) -> dict:
+    results = {}
+    for name in names:
+        results[name] = {str(size): BENCHMARKS[name](size) for size in sizes}
+    return {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sizes": sizes,
+        },
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WordGame benchmarks")
+    parser.add_argument("names", nargs="*", default=[],
+                        help="benchmarks to run, all of them by default: "
+                             + ", ".join(BENCHMARKS))
+    parser.add_argument("-n", "--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 100000],
+                        help="deck sizes in lines, up to 10000000")
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="also write the json results to this file")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+    report = run_benchmarks(args.names or list(BENCHMARKS), args.sizes)
+    print(json.dumps(report, indent=4))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
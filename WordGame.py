@@ -1,32 +1,75 @@
+from array import array
+from collections import Counter, OrderedDict, deque
+from heapq import heapify, heappop, heappush
 from copy import deepcopy
 from datetime import datetime
 from enum import Enum
-from os import listdir, system
-from os.path import join
-from random import choice, shuffle
-from typing import List
+from functools import wraps
+from itertools import accumulate, chain, islice
+from math import log
+from operator import add
+from os import fstat, fsync, getpid, listdir, remove, replace, stat, system
+from os.path import abspath, exists, join, splitext
+from random import Random, choice, getrandbits, shuffle
+from random import getstate as get_random_state, seed as seed_random, \
+    setstate as set_random_state
+from time import perf_counter_ns
+from typing import TYPE_CHECKING, List
+from weakref import WeakKeyDictionary
 import json
+import marshal
+import shlex
+import struct
+import sys
+import threading
+import unicodedata
+import zlib
+
+if TYPE_CHECKING:
+    # Imported where it is used, it is slow to import
+    import asyncio
 
 # TODO: Add proper error handling instead of supressing
 game_loop_supress_error = True
 
 DEFAULT_SETTINGS_PATH = "settings.json"
 
-DEFAULT_GAME_HISTORY_PATH = "game_history.json"
+DEFAULT_GAME_HISTORY_PATH = "game_history.db"
 
-DEFAULT_GAME_SAVES_PATH = "game_saves.json"
+DEFAULT_GAME_SAVES_PATH = "game_saves.db"
+
+DEFAULT_DECK_CACHE_PATH = "deck_cache.bin"
+
+DEFAULT_AUTOSAVE_PATH = "game_autosave.sav"
 
 
 ############################# Basic file save/load handling
 
 
-def save_data_to_json(data: dict, file_path: str):
+def save_data_to_file(data, file_path: str):
+    # data is bytes or an iterable of bytes chunks. Written to a temp file
+    # that then replaces file_path, so a crash leaves either the old file
+    # or the new one. Failures are raised.
+    temp_path = f"{file_path}.{getpid()}.{threading.get_ident()}.tmp"
     try:
-        with open(file_path, 'w') as f:
-            json.dump(data, f, indent=4)
-        return True
-    except Exception as e:
-        return None
+        with open(temp_path, 'wb') as f:
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                f.write(data)
+            else:
+                f.writelines(data)
+            f.flush()
+            fsync(f.fileno())
+        replace(temp_path, file_path)
+    except BaseException:
+        if exists(temp_path):
+            remove(temp_path)
+        raise
+    return True
+
+
+
+def save_data_to_json(data: dict, file_path: str):
+    return save_data_to_file(json.dumps(data, indent=4).encode('utf-8'), file_path)
 
 
 
@@ -45,7 +88,11 @@ def init_default(file_path: str, else_default):
     if ld != None:
         return ld
     else:
-        save_data_to_json(else_default, file_path)
+        try:
+            save_data_to_json(else_default, file_path)
+        except OSError as e:
+            # The defaults still work, they are just not written out
+            pass
         return deepcopy(else_default) 
 
 
@@ -74,19 +121,287 @@ DEFAULT_GAME_SETTINGS = {
     "from_side": SideChoice.RANDOM.value,
     # Typing mode specific
     "typing_mode": False,
+    "spaced_repetition": False,
+    "leitner_boxes": 3,
+    "leitner_interval": 4,
     "case_senstive": False,
     "white_space_senstive": False,
+    "strip_accents": False,
+    "typo_tolerance": 0,
+    # Multiple choice mode
+    "multiple_choice": False,
+    "distractor_count": 3,
     # Info
     "show_position": True,
     "show_mistake_count": True,
     "show_score": True,
     "no_cls": False,
+    # Prompts made ahead while the current line is answered, 0 turns it off
+    "prefetch_prompts": 4,
     # Afixes
     "split": " - ",
-    "comment": "#"
+    "comment": "#",
+    # Loading
+    "deck_cache": True,
+    "load_workers": 0,
+    "deck_index": False,
+    "dedupe": False,
+    # Saves
+    "session_cache_size": 8,
+    "autosave_answers": 20,
+    "autosave_seconds": 30,
+    # Diagnostics
+    "instrumentation": False
 }
 
-settings = init_default(DEFAULT_SETTINGS_PATH, DEFAULT_GAME_SETTINGS)
+def load_settings(file_path: str = DEFAULT_SETTINGS_PATH) -> dict:
+    # Settings files written by older versions lack the newer keys
+    return {**DEFAULT_GAME_SETTINGS,
+            **init_default(file_path, DEFAULT_GAME_SETTINGS)}
+
+
+############################# Instrumentation
+
+
+class LatencyHistogram:
+    # Latencies in nanoseconds counted into log spaced buckets about 5% wide,
+    # so recording is O(1), memory stays bounded and percentiles are within
+    # a bucket of the real value
+    BUCKET_BASE = 1.05
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self, ns: int):
+        self.buckets[int(log(max(ns, 1), self.BUCKET_BASE))] += 1
+        self.count += 1
+        self.total_ns += ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+
+    def percentile(self, percent: float) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = percent / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.BUCKET_BASE ** (bucket + 1), self.max_ns)
+        return float(self.max_ns)
+
+    def summary(self) -> dict:
+        ms = 10**6
+        return {
+            "count": self.count,
+            "total_ms": self.total_ns / ms,
+            "p50_ms": self.percentile(50) / ms,
+            "p95_ms": self.percentile(95) / ms,
+            "p99_ms": self.percentile(99) / ms,
+            "max_ms": self.max_ns / ms,
+        }
+
+
+class _PhaseTimer:
+    __slots__ = ("instrumentation", "phase", "start")
+
+    def __init__(self, instrumentation: "Instrumentation", phase: str):
+        self.instrumentation = instrumentation
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.record(self.phase, perf_counter_ns() - self.start)
+        return False
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+class Instrumentation:
+    # Opt in timers and counters per phase. While disabled, timer() hands
+    # out a shared no-op context so the instrumented code pays one check.
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.histograms: dict = {}
+        self.counters = Counter()
+
+    def timer(self, phase: str):
+        if not self.enabled:
+            return _NO_TIMER
+        return _PhaseTimer(self, phase)
+
+    def timed(self, phase: str):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with _PhaseTimer(self, phase):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, phase: str, ns: int):
+        histogram = self.histograms.get(phase)
+        if histogram is None:
+            histogram = self.histograms[phase] = LatencyHistogram()
+        histogram.record(ns)
+
+    def count(self, counter: str, amount: int = 1):
+        if self.enabled:
+            self.counters[counter] += amount
+
+    def reset(self):
+        self.histograms = {}
+        self.counters = Counter()
+
+    def summary(self) -> dict:
+        return {
+            "phases": {phase: histogram.summary()
+                       for phase, histogram in sorted(self.histograms.items())},
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+
+# Turned on by the instrumentation setting once the settings are loaded
+instrumentation = Instrumentation()
+
+
+############################# Rendering
+
+
+class TerminalRenderer:
+    # Draws the game with ANSI escape codes instead of a cls subprocess.
+    # Everything drawn for a frame is buffered and written in one go by
+    # flush(), and a row is only redrawn when its text changed. Without a
+    # terminal, or with no_cls set, text is just written out in order.
+    def __init__(self, stream = None, ansi: bool = None):
+        self.stream = sys.stdout if stream is None else stream
+        if ansi is None:
+            ansi = self.stream.isatty() and context.settings["no_cls"] == False
+            if ansi and sys.platform == "win32":
+                # Turns on escape code handling in the Windows console
+                system("")
+        self.ansi = ansi
+        self.buffer: List[str] = []
+        # Text currently on each screen row, rows count from 1
+        self.rows: dict = {}
+
+    def write(self, text: str):
+        self.buffer.append(text)
+
+    def clear(self):
+        if self.ansi:
+            self.buffer.append("\x1b[H\x1b[2J")
+            self.rows = {}
+
+    def row(self, row: int, text: str):
+        if not self.ansi:
+            if text != "":
+                self.buffer.append(text + "\n")
+            return
+        if self.rows.get(row) != text:
+            self.buffer.append(f"\x1b[{row};1H\x1b[2K{text}")
+            self.rows[row] = text
+
+    def prompt(self, row: int, text: str):
+        # Draws an input row, clearing everything under it and leaving the
+        # cursor after the text
+        if not self.ansi:
+            self.buffer.append(text)
+            return
+        self.buffer.append(f"\x1b[{row};1H\x1b[J{text}")
+        self.rows = {key: value for key, value in self.rows.items() if key < row}
+
+    def flush(self):
+        if self.buffer:
+            self.stream.write("".join(self.buffer))
+            self.buffer = []
+        self.stream.flush()
+
+
+############################# Context
+
+
+class GameContext:
+    # The state backed by files: settings, game history and the deck cache.
+    # Nothing is read or written until first use, so importing the module
+    # stays free of disk I/O.
+    def __init__(self, settings_path: str = DEFAULT_SETTINGS_PATH,
+                 game_history_path: str = DEFAULT_GAME_HISTORY_PATH,
+                 deck_cache_path: str = DEFAULT_DECK_CACHE_PATH):
+        self.settings_path = settings_path
+        self.game_history_path = game_history_path
+        self.deck_cache_path = deck_cache_path
+        self._settings: dict = None
+        self._game_history = None
+        self._deck_cache = None
+        self._renderer = None
+        self._line_stats = None
+        # LineStore to the DistractorIndex over its answers
+        self.distractor_indexes = WeakKeyDictionary()
+        # LineStore to (folder path, DeckIndex) of every deck still in use,
+        # the index is None until it is first needed
+        self.deck_indexes = WeakKeyDictionary()
+
+    @property
+    def settings(self) -> dict:
+        if self._settings is None:
+            self._settings = load_settings(self.settings_path)
+            instrumentation.enabled = self._settings["instrumentation"]
+        return self._settings
+
+    @property
+    def game_history(self) -> "GameHistory":
+        if self._game_history is None:
+            self._game_history = GameHistory(self.game_history_path)
+        return self._game_history
+
+    @property
+    def deck_cache(self) -> "DeckCache":
+        if self._deck_cache is None:
+            self._deck_cache = DeckCache(self.deck_cache_path)
+        return self._deck_cache
+
+    @property
+    def line_stats(self) -> "LineStats":
+        if self._line_stats is None:
+            self._line_stats = LineStats(self.game_history)
+        return self._line_stats
+
+    @property
+    def renderer(self) -> TerminalRenderer:
+        if self._renderer is None:
+            self._renderer = TerminalRenderer()
+        return self._renderer
+
+
+context = GameContext()
+
+
+def __getattr__(name: str):
+    # WordGame.settings, .game_history and .deck_cache used to be module
+    # globals filled at import, they now come from the context
+    if name in ("settings", "game_history", "deck_cache"):
+        return getattr(context, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 ############################# Game data
@@ -96,52 +411,395 @@ GAME_DATA = {
     "mistake_count": 0,
     "current_line": 0,
     "remaining_lines": [],
-    "settings": settings    # TODO: Make settings completly independent of GAME_DATA
+    # When set, remaining_lines holds ids into this LineStore
+    "line_store": None,
+    # Scheduling state of the answer queue lined up with remaining_lines
+    "queue_state": None,
+    "settings": None    # TODO: Make settings completly independent of GAME_DATA
 }
 
 
 
+def get_default_game_data():
+    gd = deepcopy(GAME_DATA)
+    gd["settings"] = deepcopy(context.settings)
+    return gd
+
+
+
+def game_data_lines(gd: dict) -> list:
+    line_store = gd.get("line_store")
+    if line_store is None:
+        return list(gd["remaining_lines"])
+    return [line_store[id] for id in gd["remaining_lines"]]
+
+
+
+def game_data_line_store(gd: dict):
+    # Returns the store and the ids of the remaining lines in it, building a
+    # store for game data that still holds Line objects
+    line_store = gd.get("line_store")
+    if line_store is None:
+        line_store = as_line_store(gd["remaining_lines"])
+        return line_store, range(len(line_store))
+    return line_store, gd["remaining_lines"]
+
+
+
+def game_data_to_json(gd: dict) -> dict:
+    json_gd = {key: value for key, value in gd.items() if key != "line_store"}
+    json_gd['remaining_lines'] = [line.to_dict() for line in game_data_lines(gd)]
+    return json_gd
+
+
+
+def game_data_from_json(json_gd: dict) -> dict:
+    gd = dict(json_gd)
+    gd['remaining_lines'] = [Line.from_dict(line) for line in json_gd['remaining_lines']]
+    return gd
+
+
+
 def save_game_data_list(gdl, file_path: str):
-    try:
-        for gd in gdl:
-            gd['remaining_lines'] = [line.to_dict() for line in gd['remaining_lines']]
-    except Exception as e:
-        return None
-    return save_data_to_json(gdl, file_path)
+    # Binary unless the file is named .json
+    if splitext(file_path)[1].lower() == ".json":
+        return save_data_to_json([game_data_to_json(gd) for gd in gdl], file_path)
+    return save_data_to_file(pack_game_data_list(gdl), file_path)
 
 
 
 def load_game_data_list(file_path: str) -> List[dict]:
     if file_path == None or file_path == "":
         return []
-    
-    game_data_list = load_data_from_json(file_path)
-    if game_data_list == None:
-        return []
-    
+
     try:
-        for gd in game_data_list:       # TODO: Add error handling
-            gd['remaining_lines'] = [Line.from_dict(line) for line in gd['remaining_lines']]    
-    except Exception as e:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    except OSError as e:
         return []
 
-    return game_data_list
+    try:       # TODO: Add error handling
+        if data.startswith(_SAVE_LIST_MAGIC):
+            return unpack_game_data_list(data)
+        # Saves written before the binary format, or exported as json
+        return [game_data_from_json(gd) for gd in json.loads(data)]
+    except Exception as e:
+        return []
     
 
 
-def get_default_game_data():
-    return deepcopy(GAME_DATA)
+############################# Save format
+
+
+# A saved game is a header (magic, format version, flags) and a body of
+# length prefixed chunks, zlib compressed when SAVE_COMPRESSED is set. The
+# first chunk is json with the small fields of the game and the source of
+# its lines, the rest are LineStore columns, the remaining lines as ids and
+# the scheduling state of every remaining line. A game on a compiled deck
+# or a deck folder keeps only the path, plus the file and index of every
+# line for a folder, and the deck is opened again on load. The text of the
+# lines is only saved when they have no source on disk.
+SAVE_FORMAT_VERSION = 1
+SAVE_COMPRESSED = 1
+_SAVE_MAGIC = b"WGSV"
+_SAVE_LIST_MAGIC = b"WGSL"
+_SAVE_HEADER = struct.Struct("<4sHH")
+_SAVE_LIST_HEADER = struct.Struct("<4sHI")
+_SAVE_CHUNK = struct.Struct("<Q")
+# Typed chunks after the json one, the utf-8 text of the lines comes last
+_SAVE_COLUMNS = (("left_lens", 'I'), ("right_lens", 'I'), ("sides", 'b'),
+                 ("indices", 'i'), ("file_ids", 'i'), ("remaining", 'I'),
+                 ("card_dues", 'q'), ("card_boxes", 'b'))
+_SAVED_STORE_COLUMNS = ("left_lens", "right_lens", "sides", "indices", "file_ids")
+
+
+def _little_endian_bytes(values: array) -> bytes:
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _little_endian_array(typecode: str, data) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def _deck_source(line_store) -> dict:
+    # Where the lines of a store can be read again, None when the save has
+    # to hold them itself
+    if isinstance(line_store, MappedDeck):
+        return {"compiled": line_store.file_path,
+                "fingerprint": list(line_store.fingerprint)}
+    if type(line_store) is LineStore and line_store.directory is not None:
+        # Parser settings are the same for every file of a load
+        fingerprint = next(iter(line_store.file_fingerprints.values()), None)
+        if fingerprint is not None:
+            return {"folder": line_store.directory,
+                    "files": list(line_store.file_fingerprints),
+                    "parser": list(fingerprint[2:])}
+    return None
+
+
+def _id_runs(ids) -> tuple:
+    # (runs, listed ids), a run for every part of joined ids. A range or an
+    # index permutation is saved as its parameters, any other ids are listed.
+    parts = ids.parts if isinstance(ids, JoinedIds) else [(ids, 0, len(ids))]
+    runs = []
+    listed = array('I')
+    for sequence, start, stop in parts:
+        if isinstance(sequence, range):
+            part = sequence[start:stop]
+            runs.append({"range": [part.start, part.stop, part.step]})
+        elif isinstance(sequence, IndexPermutation) and sequence.source is None:
+            part = sequence[start:stop]
+            runs.append({"permutation": [part.length, list(part.keys),
+                                         part.start, part.stop]})
+        else:
+            if isinstance(sequence, (list, array)):
+                listed.extend(array('I', sequence[start:stop]))
+            else:
+                listed.extend(array('I', map(sequence.__getitem__, range(start, stop))))
+            runs.append({"ids": stop - start})
+    return runs, listed
+
+
+def _runs_ids(runs: list, listed: array):
+    parts = []
+    offset = 0
+    for run in runs:
+        if "range" in run:
+            parts.append(range(*run["range"]))
+        elif "permutation" in run:
+            length, keys, start, stop = run["permutation"]
+            parts.append(IndexPermutation(length, tuple(keys), start, stop))
+        else:
+            parts.append(listed[offset:offset + run["ids"]])
+            offset += run["ids"]
+    if len(parts) == 1:
+        return parts[0]
+    return JoinedIds([(part, 0, len(part)) for part in parts])
+
+
+def _saved_lines(line_store, ids, line_count: int) -> tuple:
+    # (columns, text, file names, remaining) for the lines behind ids, out
+    # of the first line_count lines of the store. A game still playing most
+    # of a plain store saves all of them with its ids as they are, otherwise
+    # the lines are copied out in the order first used.
+    if type(line_store) is LineStore and len(ids) * 2 >= line_count:
+        columns = {name: getattr(line_store, name)[:line_count]
+                   for name in _SAVED_STORE_COLUMNS}
+        end = 0
+        if line_count > 0:
+            end = line_store.offsets[line_count - 1] + \
+                columns["left_lens"][-1] + columns["right_lens"][-1]
+        if sum(columns["left_lens"]) + sum(columns["right_lens"]) == end:
+            return columns, line_store.text[:end], list(line_store.file_names), ids
+
+    saved_ids = {id: saved_id for saved_id, id in enumerate(dict.fromkeys(ids))}
+    columns = {"left_lens": array('I'), "right_lens": array('I'), "sides": array('b'),
+               "indices": array('i'), "file_ids": array('i')}
+    text = bytearray()
+    saved_file_ids = {}
+    for id in saved_ids:
+        start = line_store.offsets[id]
+        left_len, right_len = line_store.left_lens[id], line_store.right_lens[id]
+        text += line_store.text[start:start + left_len + right_len]
+        columns["left_lens"].append(left_len)
+        columns["right_lens"].append(right_len)
+        columns["sides"].append(line_store.sides[id])
+        columns["indices"].append(line_store.indices[id])
+        file_id = line_store.file_ids[id]
+        if file_id >= 0:
+            file_id = saved_file_ids.setdefault(file_id, len(saved_file_ids))
+        columns["file_ids"].append(file_id)
+    file_names = [line_store.file_names[file_id] for file_id in saved_file_ids]
+    return columns, text, file_names, array('I', map(saved_ids.__getitem__, ids))
+
+
+def _save_parts(gd: dict, info: dict = None) -> tuple:
+    # What a save needs from a game, cheap enough to take on a turn: the
+    # small fields, the cards of the asked lines and the remaining ids as
+    # the game holds them. The store is only read by _pack_save_parts, which
+    # can run on another thread while the game goes on; it only ever grows
+    # between reloads, so its first lines are the ones the game knew.
+    line_store, ids = game_data_line_store(gd)
+    queue_state = gd.get("queue_state")
+    meta = {
+        "mistake_count": gd["mistake_count"],
+        "current_line": gd["current_line"],
+        "settings": dict(gd["settings"]),
+        "queue_turn": None if queue_state is None else queue_state["turn"],
+        "source": _deck_source(line_store),
+        "info": info,
+    }
+    cards = [] if queue_state is None else queue_state["cards"]
+    return meta, line_store, len(line_store), line_store.reloads, ids, cards
+
+
+def _save_parts_stale(parts: tuple) -> bool:
+    # True when the store was reloaded since the parts were taken, lines
+    # read from it since then can be newer than the game
+    return parts[1].reloads != parts[3]
+
+
+def _pack_save_parts(parts: tuple, compress: bool = True) -> bytes:
+    meta, line_store, line_count, _, ids, cards = parts
+    source = meta["source"]
+    if source is None:
+        columns, text, file_names, ids = _saved_lines(line_store, ids, line_count)
+    else:
+        # A compiled deck is never copied, a folder only needs the file and
+        # index of every line to find them again
+        columns = {name: array(typecode) for name, typecode in _SAVE_COLUMNS
+                   if name in _SAVED_STORE_COLUMNS}
+        text = b""
+        file_names = []
+        if "folder" in source:
+            columns["indices"] = line_store.indices[:line_count]
+            columns["file_ids"] = line_store.file_ids[:line_count]
+            file_names = list(line_store.file_names)
+    runs, columns["remaining"] = _id_runs(ids)
+    columns["card_dues"] = array('q', (-1 if card is None else card[0] for card in cards))
+    columns["card_boxes"] = array('b', (-1 if card is None else card[1] for card in cards))
+    meta = dict(meta, file_names=file_names, remaining=runs)
+
+    chunks = [json.dumps(meta).encode('utf-8')]
+    chunks.extend(_little_endian_bytes(columns[name]) for name, _ in _SAVE_COLUMNS)
+    chunks.append(text)
+    body = b"".join(part for chunk in chunks
+                    for part in (_SAVE_CHUNK.pack(len(chunk)), chunk))
+    flags = 0
+    if compress:
+        body = zlib.compress(body, 1)
+        flags |= SAVE_COMPRESSED
+    return _SAVE_HEADER.pack(_SAVE_MAGIC, SAVE_FORMAT_VERSION, flags) + body
+
+
+def pack_game_data(gd: dict, info: dict = None, compress: bool = True) -> bytes:
+    # info is any json the caller wants kept with the game
+    return _pack_save_parts(_save_parts(gd, info), compress)
+
+
+def unpack_game_data(data) -> tuple:
+    # (game data, info) of a game packed by pack_game_data, ValueError when
+    # data is not a saved game or comes from a newer format version
+    data = memoryview(data)
+    if len(data) < _SAVE_HEADER.size:
+        raise ValueError("not a saved game")
+    magic, version, flags = _SAVE_HEADER.unpack_from(data)
+    if magic != _SAVE_MAGIC:
+        raise ValueError("not a saved game")
+    if version > SAVE_FORMAT_VERSION:
+        raise ValueError(f"saved game format {version} is newer than this version")
+    body = data[_SAVE_HEADER.size:]
+    if flags & SAVE_COMPRESSED:
+        body = memoryview(zlib.decompress(body))
+
+    chunks = []
+    offset = 0
+    while offset < len(body):
+        (size,) = _SAVE_CHUNK.unpack_from(body, offset)
+        offset += _SAVE_CHUNK.size
+        chunks.append(body[offset:offset + size])
+        offset += size
+    if len(chunks) != len(_SAVE_COLUMNS) + 2:
+        raise ValueError("saved game is cut short")
+
+    meta = json.loads(bytes(chunks[0]))
+    columns = {name: _little_endian_array(typecode, chunk)
+               for (name, typecode), chunk in zip(_SAVE_COLUMNS, chunks[1:])}
+    ids = _runs_ids(meta["remaining"], columns["remaining"])
+    cards = [None if due < 0 else [due, box] for due, box in
+             zip(columns["card_dues"], columns["card_boxes"])]
+    if meta["source"] is None:
+        line_store = LineStore.from_columns(
+            chunks[-1], meta["file_names"],
+            **{name: columns[name] for name in _SAVED_STORE_COLUMNS})
+    else:
+        line_store, ids, cards = _reopened_deck(meta["source"], meta["file_names"],
+                                                columns, ids, cards)
+
+    queue_state = None
+    if meta["queue_turn"] is not None:
+        queue_state = {"turn": meta["queue_turn"], "cards": cards}
+    gd = dict(GAME_DATA, mistake_count=meta["mistake_count"],
+              current_line=meta["current_line"], remaining_lines=ids,
+              line_store=line_store, queue_state=queue_state,
+              settings=meta["settings"])
+    return gd, meta["info"]
+
+
+def _reopened_deck(source: dict, file_names: List[str], columns: dict,
+                   ids, cards: list) -> tuple:
+    # (store, ids, cards) of a game saved with the source of its lines. A
+    # compiled deck has to be the file the game was played on. A folder is
+    # read again and its lines are found by file and index, the way a
+    # reload matches them, lines no longer there leave the game.
+    if "compiled" in source:
+        line_store = MappedDeck(source["compiled"])
+        if list(line_store.fingerprint) != source["fingerprint"]:
+            raise ValueError(f"{source['compiled']} changed since the game was saved")
+        return line_store, ids, cards
+
+    split_, comment, multi_line_comment = source["parser"]
+    cache = context.deck_cache if context.settings["deck_cache"] == True else None
+    line_store = load_files_on_dir(source["folder"], source["files"], cache=cache,
+                                   comment=comment, multi_line_comment=multi_line_comment,
+                                   split_=split_, errors={})
+    if cache is not None:
+        cache.save()
+    file_ids, indices = columns["file_ids"], columns["indices"]
+    if line_store.file_names == file_names and line_store.file_ids == file_ids \
+            and line_store.indices == indices:
+        return line_store, ids, cards
+
+    new_ids = {(line_store.get_file(id), line_store.indices[id]): id
+               for id in range(len(line_store))}
+    saved_ids = [new_ids.get((None if file_id < 0 else file_names[file_id], index), -1)
+                 for file_id, index in zip(file_ids, indices)]
+    kept_ids, kept_cards = [], []
+    for position, id in enumerate(ids):
+        if saved_ids[id] < 0:
+            continue
+        kept_ids.append(saved_ids[id])
+        if position < len(cards):
+            kept_cards.append(cards[position])
+    return line_store, kept_ids, kept_cards
+
+
+def pack_game_data_list(gdl, compress: bool = True) -> bytes:
+    games = [pack_game_data(gd, compress=compress) for gd in gdl]
+    return _SAVE_LIST_HEADER.pack(_SAVE_LIST_MAGIC, SAVE_FORMAT_VERSION, len(games)) + \
+        b"".join(part for game in games for part in (_SAVE_CHUNK.pack(len(game)), game))
+
+
+def unpack_game_data_list(data) -> List[dict]:
+    data = memoryview(data)
+    magic, version, count = _SAVE_LIST_HEADER.unpack_from(data)
+    if magic != _SAVE_LIST_MAGIC:
+        raise ValueError("not a list of saved games")
+    if version > SAVE_FORMAT_VERSION:
+        raise ValueError(f"saved game format {version} is newer than this version")
+    gdl = []
+    offset = _SAVE_LIST_HEADER.size
+    for _ in range(count):
+        (size,) = _SAVE_CHUNK.unpack_from(data, offset)
+        offset += _SAVE_CHUNK.size
+        gdl.append(unpack_game_data(data[offset:offset + size])[0])
+        offset += size
+    return gdl
 
 
 ############################# Lines
 
 
-class Line:
-    def __init__(self, left: str, right: str, side_answer: SideChoice = SideChoice.RANDOM):
-        self.left = left
-        self.right = right
-        self.side_answer = side_random_handle(side_answer)
-        self.index:int = None
+class LineBase:
+    # Behaviour shared by standalone lines and lines kept in a LineStore
+    __slots__ = ()
 
     def __str__(self):
         return f"{self.left} - {self.right}"
@@ -151,74 +809,408 @@ class Line:
 
         if side == SideChoice.LEFT:
             ret =  f"{self.left}"
-            ret += settings["split"] if show_split == True else ""
+            ret += context.settings["split"] if show_split == True else ""
             return ret
         #elif side == SideChoice.RIGHT:
         ret =  f"{self.right}"
-        ret = settings["split"] + ret if show_split == True else ret
+        ret = context.settings["split"] + ret if show_split == True else ret
         return ret
 
     def to_dict(self):
+        side_answer = self.side_answer
         return {
             "left": self.left,
             "right": self.right,
             "index": self.index,
-            "correct_answer_side": self.correct_answer_side,
-            "show_user_side": self.show_user_side,
+            "file": self.file,
+            "side_answer": None if side_answer is None else side_answer.value,
         }
 
+
+class Line(LineBase):
+    __slots__ = ("left", "right", "side_answer", "index", "file")
+
+    def __init__(self, left: str, right: str, side_answer: SideChoice = SideChoice.RANDOM):
+        self.left = left
+        self.right = right
+        self.side_answer = side_random_handle(side_answer)
+        self.index:int = None
+        self.file:str = None
+
     @classmethod
     def from_dict(cls, data):
-        line = cls(data["left"], data["right"], None)
+        side_answer = data.get("side_answer")
+        line = cls(data["left"], data["right"],
+                   None if side_answer is None else SideChoice(side_answer))
         line.index = data["index"]
-        line.correct_answer_side = data["correct_answer_side"]
-        line.show_user_side = data["show_user_side"]
+        line.file = data.get("file")
         return line
 
 
+class StoredLine(LineBase):
+    # A view of one entry of a LineStore, reads and writes go to the store
+    __slots__ = ("store", "id")
+
+    def __init__(self, store: "LineStore", id: int):
+        self.store = store
+        self.id = id
+
+    @property
+    def left(self) -> str:
+        return self.store.get_left(self.id)
+
+    @property
+    def right(self) -> str:
+        return self.store.get_right(self.id)
+
+    @property
+    def index(self) -> int:
+        index = self.store.indices[self.id]
+        return None if index < 0 else index
+
+    @property
+    def file(self) -> str:
+        return self.store.get_file(self.id)
+
+    @property
+    def side_answer(self) -> SideChoice:
+        return SideChoice(self.store.sides[self.id])
+
+    @side_answer.setter
+    def side_answer(self, side: SideChoice):
+        self.store.sides[self.id] = side_random_handle(side).value
+
+
+class LineStore:
+    # Columnar storage for deck lines. The text of every line lives in one
+    # utf-8 buffer (left followed by right) and each line only costs a few
+    # entries in typed arrays, strings are decoded when a line is read.
+    # The game works on integer ids into the store instead of Line objects.
+    def __init__(self):
+        self.text = bytearray()
+        self.offsets = array('Q')
+        self.left_lens = array('I')
+        self.right_lens = array('I')
+        self.sides = array('b')
+        self.indices = array('i')
+        # Deck file of every line as an id into file_names
+        self.file_names: List[str] = []
+        self._file_name_ids: dict = {}
+        self.file_ids = array('i')
+        # Ids and fingerprint of every deck file the store was loaded from,
+        # kept for reloading only the files that changed
+        self.file_lines: dict = {}
+        self.file_fingerprints: dict = {}
+        # The folder when every line came from its deck files, saved games
+        # refer to it instead of holding the lines
+        self.directory: str = None
+        # Bumped by every reload, which can edit lines of the store in place
+        self.reloads = 0
+        self._answer_normalization: tuple = None
+        self._normalized_answers: tuple = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, id: int) -> StoredLine:
+        if id < 0:
+            id += len(self)
+        if not 0 <= id < len(self):
+            raise IndexError("line id out of range")
+        return StoredLine(self, id)
+
+    def __iter__(self):
+        for id in range(len(self)):
+            yield StoredLine(self, id)
+
+    def get_left(self, id: int) -> str:
+        start = self.offsets[id]
+        return str(self.text[start:start + self.left_lens[id]], 'utf-8')
+
+    def get_right(self, id: int) -> str:
+        start = self.offsets[id] + self.left_lens[id]
+        return str(self.text[start:start + self.right_lens[id]], 'utf-8')
+
+    def get_file(self, id: int) -> str:
+        file_id = self.file_ids[id]
+        return None if file_id < 0 else self.file_names[file_id]
+
+    def file_id(self, file: str) -> int:
+        if file is None:
+            return -1
+        file_id = self._file_name_ids.get(file)
+        if file_id is None:
+            file_id = len(self.file_names)
+            self._file_name_ids[file] = file_id
+            self.file_names.append(file)
+        return file_id
+
+    def append(self, left: str, right: str, side: SideChoice = SideChoice.RANDOM,
+               index: int = None, file: str = None) -> int:
+        id = len(self)
+        left = left.encode('utf-8')
+        right = right.encode('utf-8')
+        self.offsets.append(len(self.text))
+        self.left_lens.append(len(left))
+        self.right_lens.append(len(right))
+        self.text += left
+        self.text += right
+        self.sides.append(side_random_handle(side).value if side is not None
+                          else SideChoice.RANDOM.value)
+        self.indices.append(-1 if index is None else index)
+        self.file_ids.append(self.file_id(file))
+        return id
+
+    def append_line(self, line: LineBase) -> int:
+        return self.append(line.left, line.right, line.side_answer, line.index,
+                           line.file)
+
+    def extend(self, lines) -> range:
+        start = len(self)
+        for line in lines:
+            self.append_line(line)
+        return range(start, len(self))
+
+    def extend_packed(self, data: bytes, side = SideChoice.RANDOM,
+                      file: str = None) -> range:
+        # The deck cache format already stores left and right text next to
+        # each other, so every record is copied into the buffer in one piece
+        start = len(self)
+        text = self.text
+        offsets, left_lens, right_lens = self.offsets, self.left_lens, self.right_lens
+        indices = self.indices
+        unpack_from = _PACKED_LINE_HEADER.unpack_from
+        header_size = _PACKED_LINE_HEADER.size
+        offset = 0
+        while offset < len(data):
+            index, left_len, right_len = unpack_from(data, offset)
+            offset += header_size
+            offsets.append(len(text))
+            left_lens.append(left_len)
+            right_lens.append(right_len)
+            indices.append(index)
+            text += data[offset:offset + left_len + right_len]
+            offset += left_len + right_len
+
+        count = len(self) - start
+        if side == SideChoice.RANDOM:
+            self.sides.extend(getrandbits(1) + 1 for _ in range(count))
+        else:
+            self.sides.extend([side.value] * count)
+        self.file_ids.extend([self.file_id(file)] * count)
+        return range(start, len(self))
+
+    def _new_answer_cache(self):
+        return [None] * len(self)
+
+    def normalized_answer(self, id: int, side: SideChoice, normalization: tuple) -> str:
+        # Answers are normalized once per line and side and then reused
+        if normalization != self._answer_normalization:
+            self._answer_normalization = normalization
+            self._normalized_answers = (self._new_answer_cache(),
+                                        self._new_answer_cache())
+        cache = self._normalized_answers[side == SideChoice.RIGHT]
+        if isinstance(cache, list) and id >= len(cache):
+            cache.extend([None] * (len(self) - len(cache)))
+        answer = cache[id]
+        if answer is None:
+            text = self.get_left(id) if side == SideChoice.LEFT else self.get_right(id)
+            answer = normalize_answer(text, *normalization)
+            cache[id] = answer
+        return answer
+
+    def prepare_answers(self, normalization: tuple):
+        for id in range(len(self)):
+            self.normalized_answer(id, SideChoice.LEFT, normalization)
+            self.normalized_answer(id, SideChoice.RIGHT, normalization)
+
+    @classmethod
+    def from_lines(cls, lines) -> "LineStore":
+        store = cls()
+        store.extend(lines)
+        return store
+
+    @classmethod
+    def from_columns(cls, text, file_names: List[str], left_lens: array,
+                     right_lens: array, sides: array, indices: array,
+                     file_ids: array) -> "LineStore":
+        # A store around columns read back from a save, where the text of
+        # every line directly follows the one before it
+        store = cls()
+        store.text = bytearray(text)
+        store.offsets = array('Q', accumulate(map(add, left_lens, right_lens), initial=0))
+        store.offsets.pop()
+        store.left_lens, store.right_lens = left_lens, right_lens
+        store.sides, store.indices, store.file_ids = sides, indices, file_ids
+        store.file_names = list(file_names)
+        store._file_name_ids = {name: id for id, name in enumerate(store.file_names)}
+        return store
+
+
+def as_line_store(lines) -> LineStore:
+    if isinstance(lines, LineStore):
+        return lines
+    return LineStore.from_lines(lines)
+
+
+############################# Answer matching
+
+
+def answer_normalization(settings: dict) -> tuple:
+    return (settings["case_senstive"], settings["white_space_senstive"],
+            settings.get("strip_accents", False))
+
+
+def normalize_answer(text: str, case_senstive: bool = False,
+                     white_space_senstive: bool = False,
+                     strip_accents: bool = False) -> str:
+    text = unicodedata.normalize("NFKC", text)
+    if strip_accents:
+        text = ''.join(char for char in unicodedata.normalize("NFD", text)
+                       if not unicodedata.combining(char))
+        text = unicodedata.normalize("NFC", text)
+    if case_senstive == False:
+        text = text.casefold()
+    if white_space_senstive == False:
+        text = ''.join(text.split())
+    return text
+
+
+def within_edit_distance(a: str, b: str, max_distance: int) -> bool:
+    # Levenshtein distance limited to a band of max_distance around the
+    # diagonal, gives up as soon as a whole row is over the limit. Only the
+    # band is computed, so a check costs O(max_distance * len) at most.
+    if abs(len(a) - len(b)) > max_distance:
+        return False
+    if a == b:
+        return True
+    if len(a) > len(b):
+        a, b = b, a
+    over = max_distance + 1
+    previous = [j if j <= max_distance else over for j in range(len(b) + 1)]
+    current = [over] * (len(b) + 1)
+    for i in range(1, len(a) + 1):
+        low = max(1, i - max_distance)
+        high = min(len(b), i + max_distance)
+        if low == 1:
+            current[0] = i if i <= max_distance else over
+        else:
+            current[low - 1] = over
+        row_min = current[low - 1]
+        char_a = a[i - 1]
+        for j in range(low, high + 1):
+            value = previous[j - 1] + (char_a != b[j - 1])
+            if previous[j] + 1 < value:
+                value = previous[j] + 1
+            if current[j - 1] + 1 < value:
+                value = current[j - 1] + 1
+            if value > over:
+                value = over
+            current[j] = value
+            if value < row_min:
+                row_min = value
+        if row_min > max_distance:
+            return False
+        if high < len(b):
+            # The next row reads one cell past this band
+            current[high + 1] = over
+        previous, current = current, previous
+    return previous[len(b)] <= max_distance
+
+
 
 # TODO: Add error handling? Add Whitelist. Change the defaults to work with settings
 # but not necesairly here
-def raw_lines_to_line_list(raw_lines: List[str], 
-blacklist = [], comment = "#", multi_line_comment = '"""',
-split_ = " - ", side = SideChoice.RANDOM) -> List[Line]:
-    lines = list()
+def iter_line_records(raw_lines, blacklist = (), comment = "#",
+multi_line_comment = '"""', split_ = " - "):
+    # Single pass over any iterable of raw lines (a list or an open file),
+    # yields (index, left, right) as they are parsed so nothing else is kept
+    # in memory
+    blacklist = set(blacklist)
+    ml_len = len(multi_line_comment)
     inside_ml_com = False
     for index, line in enumerate(raw_lines, start=1):
-        if index not in blacklist:
-
-            to_remove = None
-            while multi_line_comment in line:
-                start_index = line.find(multi_line_comment)
-
+        if index in blacklist:
+            continue
+
+        if inside_ml_com or multi_line_comment in line:
+            kept = []
+            position = 0
+            while True:
+                found = line.find(multi_line_comment, position)
                 if inside_ml_com:
-                    to_remove = line[:start_index + len(multi_line_comment)]
+                    if found == -1:
+                        break
                     inside_ml_com = False
-                elif (end_index := line.find(multi_line_comment,
-                start_index + len(multi_line_comment))) != -1:
-                    to_remove = line[start_index:end_index + len(multi_line_comment)]
                 else:
-                    to_remove = line[start_index:]
+                    if found == -1:
+                        kept.append(line[position:])
+                        break
+                    kept.append(line[position:found])
                     inside_ml_com = True
+                position = found + ml_len
+            line = ''.join(kept)
 
-                if to_remove is not None:
-                    line = line.replace(to_remove, '', 1)
-                    to_remove = None
+        if comment in line:
+            line = line[:line.index(comment)]
 
-            if comment in line:
-                line = line[:line.index(comment)]
+        if split_ in line:
+            left, right = line.strip().split(split_)
+            yield index, left, right
 
-            if split_ in line:
-                left, right = line.strip().split(split_)
-                append_line = Line(left, right, side)
-                append_line.index = index
-                lines.append(append_line)
-    return lines
+
+def iter_line_list(raw_lines, blacklist = (), comment = "#",
+multi_line_comment = '"""', split_ = " - ", side = SideChoice.RANDOM):
+    for index, left, right in iter_line_records(raw_lines, blacklist, comment,
+                                                multi_line_comment, split_):
+        append_line = Line(left, right, side)
+        append_line.index = index
+        yield append_line
+
+
+def raw_lines_to_line_list(raw_lines: List[str],
+blacklist = [], comment = "#", multi_line_comment = '"""',
+split_ = " - ", side = SideChoice.RANDOM) -> List[Line]:
+    return list(iter_line_list(raw_lines, blacklist, comment,
+                               multi_line_comment, split_, side))
+
+
+def _parse_deck_file(file_path_: str, parser_settings: tuple):
+    # Pool worker, returns the lines packed so the result pickles cheaply.
+    # Errors are returned instead of raised so one bad file can't stop the load
+    split_, comment, multi_line_comment = parser_settings
+    try:
+        with open(file_path_, 'r', encoding='utf-8') as f:
+            return pack_line_records(iter_line_records(
+                f, comment=comment, multi_line_comment=multi_line_comment,
+                split_=split_)), None
+    except Exception as e:
+        return None, e
+
+
+def _parse_files_parallel(file_paths: List[str], parser_settings: tuple,
+                          workers: int) -> list:
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
+
+    chunksize = max(1, len(file_paths) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map keeps the results in file order
+        return list(executor.map(partial(_parse_deck_file,
+                                         parser_settings=parser_settings),
+                                 file_paths, chunksize=chunksize))
 
 
 # TODO: Add error handling
 def load_files_on_dir(directory: str = "\\Saves", whitelist: list = [],
-                      blacklist: list = []) -> List[Line]:
+                      blacklist: list = [], cache: "DeckCache" = None,
+                      comment = "#", multi_line_comment = '"""',
+                      split_ = " - ", workers: int = 0,
+                      errors: dict = None) -> LineStore:
+    # workers > 1 parses the files on a process pool. When an errors dict is
+    # given, files that fail to load are recorded there by name and skipped,
+    # otherwise the first failure is raised. Compiled decks are mapped, a
+    # lone compiled deck is returned as is so nothing of it is read up front.
     dir_content = listdir(directory)
 
     if blacklist:
@@ -227,44 +1219,995 @@ def load_files_on_dir(directory: str = "\\Saves", whitelist: list = [],
     if whitelist:
         dir_content = [item for item in dir_content if item in whitelist]
 
-    file_list = list()
+    parser_settings = (split_, comment, multi_line_comment)
+
+    file_payloads = [None] * len(dir_content)
+    fingerprints = {}
+    mapped_decks = {}
+    to_parse = []
+    for position, file_name in enumerate(dir_content):
+        file_path_ = join(directory, file_name)
+        if file_name.endswith(COMPILED_DECK_EXTENSION):
+            try:
+                mapped_decks[position] = MappedDeck(file_path_)
+            except Exception as e:
+                if errors is None:
+                    raise
+                errors[file_name] = e
+            continue
+        try:
+            fingerprints[position] = file_fingerprint(file_path_, parser_settings)
+        except OSError as e:
+            if errors is None:
+                raise
+            errors[file_name] = e
+            continue
+        if cache is not None:
+            payload = cache.get_packed(file_path_, parser_settings,
+                                       fingerprints[position])
+            if payload is not None:
+                file_payloads[position] = payload
+                instrumentation.count("deck_cache_hits")
+                continue
+        to_parse.append(position)
+    instrumentation.count("deck_files_parsed", len(to_parse))
+
+    to_parse_paths = [join(directory, dir_content[position]) for position in to_parse]
+    with instrumentation.timer("parse"):
+        if workers > 1 and len(to_parse) > 1:
+            results = _parse_files_parallel(to_parse_paths, parser_settings, workers)
+        else:
+            results = (_parse_deck_file(file_path_, parser_settings)
+                       for file_path_ in to_parse_paths)
+
+        for position, file_path_, (payload, error) in zip(to_parse, to_parse_paths, results):
+            if error is not None:
+                if errors is None:
+                    raise error
+                errors[dir_content[position]] = error
+                continue
+            if cache is not None:
+                cache.put_packed(file_path_, parser_settings, payload,
+                                 fingerprints[position])
+            file_payloads[position] = payload
+
+    if len(mapped_decks) == 1 and \
+            all(payload is None for payload in file_payloads):
+        return next(iter(mapped_decks.values()))
+
+    line_store = LineStore()
+    for position, (file_name, payload) in enumerate(zip(dir_content, file_payloads)):
+        if payload is not None:
+            ids = line_store.extend_packed(payload, file=file_name)
+            line_store.file_lines[file_name] = ids
+            line_store.file_fingerprints[file_name] = fingerprints[position]
+        elif position in mapped_decks:
+            line_store.extend(mapped_decks[position])
+    if not mapped_decks:
+        line_store.directory = abspath(directory)
+
+    return line_store
+
+
+def _patch_file_lines(line_store: LineStore, file_name: str, payload: bytes,
+                      replaced: dict, removed: set, added: list):
+    # Lines are matched on their index first, then on their text for lines
+    # that only moved. A new line at the index of an unmatched old one is
+    # an edit of it, anything else is added or removed.
+    old_by_index = {line_store.indices[id]: id
+                    for id in line_store.file_lines.get(file_name, ())}
+    kept = []
+    unmatched = []
+    for line in unpack_lines(payload):
+        id = old_by_index.get(line.index)
+        if id is not None and line_store.get_left(id) == line.left \
+                and line_store.get_right(id) == line.right:
+            kept.append(id)
+            del old_by_index[line.index]
+        else:
+            unmatched.append(line)
+
+    old_by_text = {}
+    for id in old_by_index.values():
+        old_by_text.setdefault((line_store.get_left(id), line_store.get_right(id)),
+                               []).append(id)
+    edited = []
+    for line in unmatched:
+        ids = old_by_text.get((line.left, line.right))
+        if ids:
+            id = ids.pop()
+            del old_by_index[line_store.indices[id]]
+            line_store.indices[id] = line.index
+            kept.append(id)
+        else:
+            edited.append(line)
+
+    for line in edited:
+        id = line_store.append(line.left, line.right, line.side_answer,
+                               line.index, file_name)
+        old_id = old_by_index.pop(line.index, None)
+        if old_id is None:
+            added.append(id)
+        else:
+            replaced[old_id] = id
+        kept.append(id)
+    removed.update(old_by_index.values())
+    line_store.file_lines[file_name] = sorted(kept)
+
+
+def reload_files_on_dir(line_store: LineStore, directory: str, whitelist: list = [],
+                        blacklist: list = [], cache: "DeckCache" = None,
+                        comment = "#", multi_line_comment = '"""',
+                        split_ = " - ", errors: dict = None):
+    # Brings a store made by load_files_on_dir up to date with its folder,
+    # parsing only the files whose fingerprint changed. New lines are
+    # appended to the store. Returns (replaced, removed, added): old id to
+    # new id of edited lines, ids of lines that are gone and ids of new
+    # lines, or None when the store was not loaded from deck files.
+    if isinstance(line_store, MappedDeck) or not line_store.file_fingerprints:
+        return None
+    line_store.reloads += 1
+    dir_content = listdir(directory)
+
+    if blacklist:
+        dir_content = [item for item in dir_content if item not in blacklist]
+
+    if whitelist:
+        dir_content = [item for item in dir_content if item in whitelist]
+
+    dir_content = [item for item in dir_content
+                   if not item.endswith(COMPILED_DECK_EXTENSION)]
+    parser_settings = (split_, comment, multi_line_comment)
+
+    replaced, removed, added = {}, set(), []
+    present = set(dir_content)
+    for file_name in list(line_store.file_lines):
+        if file_name not in present:
+            removed.update(line_store.file_lines.pop(file_name))
+            line_store.file_fingerprints.pop(file_name, None)
+
     for file_name in dir_content:
         file_path_ = join(directory, file_name)
-        with open(file_path_, 'r', encoding='utf-8') as f:
-            file_list.extend(raw_lines_to_line_list(f.readlines()))
+        try:
+            fingerprint = file_fingerprint(file_path_, parser_settings)
+        except OSError as e:
+            if errors is None:
+                raise
+            errors[file_name] = e
+            continue
+        if line_store.file_fingerprints.get(file_name) == fingerprint:
+            continue
+
+        payload = None if cache is None else \
+            cache.get_packed(file_path_, parser_settings, fingerprint)
+        if payload is None:
+            with instrumentation.timer("parse"):
+                payload, error = _parse_deck_file(file_path_, parser_settings)
+            if error is not None:
+                if errors is None:
+                    raise error
+                errors[file_name] = error
+                continue
+            instrumentation.count("deck_files_parsed")
+            if cache is not None:
+                cache.put_packed(file_path_, parser_settings, payload, fingerprint)
+        _patch_file_lines(line_store, file_name, payload, replaced, removed, added)
+        line_store.file_fingerprints[file_name] = fingerprint
+
+    return replaced, removed, added
+
+
+############################# Deck cache
+
+
+DECK_CACHE_VERSION = 1
+
+# index, left length, right length; the utf-8 text follows each header
+_PACKED_LINE_HEADER = struct.Struct("<III")
+
+
+def pack_line_records(records) -> bytes:
+    chunks = []
+    for index, left, right in records:
+        left = left.encode('utf-8')
+        right = right.encode('utf-8')
+        chunks.append(_PACKED_LINE_HEADER.pack(index, len(left), len(right)))
+        chunks.append(left)
+        chunks.append(right)
+    return b''.join(chunks)
+
+
+def pack_lines(lines: List[Line]) -> bytes:
+    return pack_line_records((line.index, line.left, line.right) for line in lines)
+
+
+def unpack_lines(data: bytes, side = SideChoice.RANDOM) -> List[Line]:
+    lines = []
+    header_size = _PACKED_LINE_HEADER.size
+    offset = 0
+    while offset < len(data):
+        index, left_len, right_len = _PACKED_LINE_HEADER.unpack_from(data, offset)
+        offset += header_size
+        left = data[offset:offset + left_len].decode('utf-8')
+        offset += left_len
+        right = data[offset:offset + right_len].decode('utf-8')
+        offset += right_len
+        line = Line(left, right, side)
+        line.index = index
+        lines.append(line)
+    return lines
+
+
+def file_fingerprint(file_path: str, parser_settings: tuple) -> tuple:
+    file_stat = stat(file_path)
+    return (file_stat.st_mtime_ns, file_stat.st_size) + tuple(parser_settings)
+
+
+class DeckCache:
+    # Parsed deck files keyed on their absolute path. An entry is only reused
+    # while the file mtime, size and the parser settings are unchanged.
+    def __init__(self, file_path: str = DEFAULT_DECK_CACHE_PATH):
+        self.file_path = file_path
+        self.entries: dict = None
+        self.dirty = False
+
+    def load(self):
+        self.entries = {}
+        try:
+            with open(self.file_path, 'rb') as f:
+                data = marshal.load(f)
+        except Exception as e:
+            return
+        if isinstance(data, dict) and data.get("version") == DECK_CACHE_VERSION:
+            self.entries = data["files"]
+
+    def save(self):
+        if not self.dirty:
+            return True
+        try:
+            save_data_to_file(marshal.dumps({"version": DECK_CACHE_VERSION,
+                                             "files": self.entries}), self.file_path)
+        except Exception as e:
+            return None
+        self.dirty = False
+        return True
+
+    def get(self, file_path: str, parser_settings: tuple):
+        payload = self.get_packed(file_path, parser_settings)
+        return None if payload is None else unpack_lines(payload)
+
+    def get_packed(self, file_path: str, parser_settings: tuple,
+                   fingerprint: tuple = None):
+        # fingerprint is the one the caller already took of the file
+        if self.entries is None:
+            self.load()
+        entry = self.entries.get(abspath(file_path))
+        if entry is None:
+            return None
+        if fingerprint is None:
+            fingerprint = file_fingerprint(file_path, parser_settings)
+        if tuple(entry[0]) != tuple(fingerprint):
+            return None
+        return entry[1]
+
+    def put(self, file_path: str, parser_settings: tuple, lines: List[Line]):
+        self.put_packed(file_path, parser_settings, pack_lines(lines))
+
+    def put_packed(self, file_path: str, parser_settings: tuple, payload: bytes,
+                   fingerprint: tuple = None):
+        # fingerprint should be taken before the file was parsed, so a file
+        # written during the parse is not cached as the new version
+        if self.entries is None:
+            self.load()
+        if fingerprint is None:
+            fingerprint = file_fingerprint(file_path, parser_settings)
+        self.entries[abspath(file_path)] = (fingerprint, payload)
+        self.dirty = True
+
+    def clear(self):
+        self.entries = {}
+        self.dirty = True
+
+
+
+
+############################# Deck index
+
+
+class DeckIndex:
+    # Hashed index over the lines of a LineStore. Every normalized side, and
+    # every word of a side with more than one, maps to the ids of the lines
+    # using it, and every normalized pair maps to the id of its first copy,
+    # so finding a word or a repeated pair is one dict lookup.
+    def __init__(self, normalization: tuple = (False, False, False)):
+        self.normalization = normalization
+        self.terms: dict = {}
+        self.pairs: dict = {}
+        # Ids of lines repeating the pair of an earlier line
+        self.duplicates: set = set()
+
+    def normalized_pair(self, line_store: LineStore, id: int) -> tuple:
+        return (normalize_answer(line_store.get_left(id), *self.normalization),
+                normalize_answer(line_store.get_right(id), *self.normalization))
+
+    def _terms_of(self, left: str, right: str, pair: tuple):
+        # Words are split before normalizing, which may drop whitespace
+        words = left.split() + right.split()
+        if len(words) <= 2:
+            return pair if pair[0] != pair[1] else pair[:1]
+        terms = set(pair)
+        terms.update(normalize_answer(word, *self.normalization) for word in words)
+        return terms
+
+    def add(self, line_store: LineStore, ids):
+        terms, pairs, duplicates = self.terms, self.pairs, self.duplicates
+        normalization = self.normalization
+        get_left, get_right = line_store.get_left, line_store.get_right
+        for id in ids:
+            left, right = get_left(id), get_right(id)
+            pair = (normalize_answer(left, *normalization),
+                    normalize_answer(right, *normalization))
+            for term in self._terms_of(left, right, pair):
+                term_ids = terms.get(term)
+                if term_ids is None:
+                    terms[term] = [id]
+                else:
+                    term_ids.append(id)
+            if pairs.setdefault(pair, id) != id:
+                duplicates.add(id)
+
+    def remove(self, line_store: LineStore, ids):
+        for id in ids:
+            pair = self.normalized_pair(line_store, id)
+            for term in self._terms_of(line_store.get_left(id),
+                                       line_store.get_right(id), pair):
+                term_ids = self.terms.get(term)
+                if term_ids is not None and id in term_ids:
+                    term_ids.remove(id)
+                    if not term_ids:
+                        del self.terms[term]
+            self.duplicates.discard(id)
+            if self.pairs.get(pair) == id:
+                # The next copy of the pair, if any, becomes the first one
+                del self.pairs[pair]
+                copies = [other for other in self.terms.get(pair[0], ())
+                          if other in self.duplicates and
+                          self.normalized_pair(line_store, other) == pair]
+                if copies:
+                    self.pairs[pair] = min(copies)
+                    self.duplicates.discard(min(copies))
+
+    def is_duplicate(self, id: int) -> bool:
+        return id in self.duplicates
+
+    def lookup(self, term: str) -> List[int]:
+        return list(self.terms.get(normalize_answer(term, *self.normalization), ()))
+
+
+############################# Multiple choice
+
+
+def _length_bucket(length: int) -> int:
+    # Exact up to 12 characters, then about 25% wide each
+    return length if length < 12 else 12 + int(log(length / 12, 1.25))
+
+
+class DistractorIndex:
+    # The answers of a LineStore, for both sides, listed by length bucket and
+    # by their first and by their last two characters within a bucket.
+    # Wrong options for a line come from the lists its own answer is in, in
+    # its bucket and the two next to it. Only SAMPLE ids at a random place
+    # of each list are read, so picking them costs the same for any deck.
+    SAMPLE = 8
+
+    def __init__(self):
+        # One dict per side: (bucket, 0, prefix) / (bucket, 1, suffix) /
+        # (bucket, 2, "") -> array of line ids
+        self.postings = ({}, {})
+        # Lines dropped by a reload stay in the store but are never offered
+        self.removed: set = set()
+        self._rng = Random()
+
+    def add(self, line_store: LineStore, ids):
+        for postings, get in zip(self.postings,
+                                 (line_store.get_left, line_store.get_right)):
+            # Gathered in lists first, appending to them is the faster part
+            added = {}
+            for id in ids:
+                text = get(id).casefold()
+                bucket = _length_bucket(len(text))
+                for key in ((bucket, 0, text[:2]), (bucket, 1, text[-2:]), (bucket, 2, "")):
+                    key_ids = added.get(key)
+                    if key_ids is None:
+                        added[key] = key_ids = []
+                    key_ids.append(id)
+            for key, key_ids in added.items():
+                if key in postings:
+                    postings[key].extend(key_ids)
+                else:
+                    postings[key] = array('I', key_ids)
+        self.removed.difference_update(ids)
+
+    def remove(self, ids):
+        self.removed.update(ids)
+
+    def _sample(self, ids, rng: Random):
+        if len(ids) <= self.SAMPLE:
+            return ids
+        start = rng.randrange(len(ids) - self.SAMPLE + 1)
+        return ids[start:start + self.SAMPLE]
+
+    def distractors(self, line_store: LineStore, id: int, side: SideChoice,
+                    count: int, normalization: tuple = (False, False, False),
+                    rng: Random = None) -> List[str]:
+        # Up to count answers of other lines on the answer side of the line,
+        # none of them graded the same as its own answer. Sharing the start
+        # or the end of the answer ranks above only having a similar length.
+        rng = self._rng if rng is None else rng
+        right = side == SideChoice.RIGHT
+        get = line_store.get_right if right else line_store.get_left
+        answer = get(id)
+        text = answer.casefold()
+        bucket = _length_bucket(len(text))
+        postings = self.postings[right]
+
+        scores = Counter()
+        for near in (bucket, bucket - 1, bucket + 1):
+            for key in ((near, 0, text[:2]), (near, 1, text[-2:]), (near, 2, "")):
+                key_ids = postings.get(key)
+                if key_ids:
+                    weight = (key[1] != 2) * 2 + (near == bucket)
+                    for candidate in self._sample(key_ids, rng):
+                        scores[candidate] += weight
+
+        seen = {normalize_answer(answer, *normalization)}
+        distractors = []
+
+        def offer(candidate: int) -> bool:
+            if candidate == id or candidate in self.removed:
+                return False
+            candidate_text = get(candidate)
+            normalized = normalize_answer(candidate_text, *normalization)
+            if normalized in seen:
+                return False
+            seen.add(normalized)
+            distractors.append(candidate_text)
+            return len(distractors) >= count
+
+        for candidate, _ in scores.most_common():
+            if offer(candidate):
+                return distractors
+        # Too few lines look alike, any other line will do
+        for _ in range(count * 8):
+            if len(line_store) < 2 or offer(rng.randrange(len(line_store))):
+                break
+        return distractors
+
+    def options(self, line_store: LineStore, id: int, side: SideChoice,
+                count: int, normalization: tuple = (False, False, False),
+                rng: Random = None) -> List[str]:
+        # The answer of the line among count distractors, shuffled
+        rng = self._rng if rng is None else rng
+        options = self.distractors(line_store, id, side, count, normalization, rng)
+        options.append(line_store.get_right(id) if side == SideChoice.RIGHT
+                       else line_store.get_left(id))
+        rng.shuffle(options)
+        return options
+
+
+def distractor_index(line_store: LineStore) -> DistractorIndex:
+    # Built by load_deck when multiple choice is on, or on first use for the
+    # lines of a saved game
+    index = context.distractor_indexes.get(line_store)
+    if index is None:
+        index = DistractorIndex()
+        index.add(line_store, range(len(line_store)))
+        context.distractor_indexes[line_store] = index
+    return index
+
+
+############################# Compiled decks
+
+
+COMPILED_DECK_EXTENSION = ".wgd"
+
+COMPILED_DECK_VERSION = 1
+
+# magic, version, line count, file names offset, text offset. The columns
+# follow the header in the order of _COMPILED_DECK_COLUMNS, each one fixed
+# width, so line n of every column is found without reading anything else.
+_COMPILED_DECK_HEADER = struct.Struct("<4sIQQQ")
+
+_COMPILED_DECK_COLUMNS = (("offsets", 'Q'), ("left_lens", 'I'),
+                          ("right_lens", 'I'), ("indices", 'i'),
+                          ("file_ids", 'i'))
+
+
+def compile_deck(lines, file_path: str):
+    # Columns are written in native byte order, only little endian is read back
+    if sys.byteorder != "little":
+        raise OSError("compiled decks need a little endian machine")
+    line_store = as_line_store(lines)
+    file_names = "\n".join(line_store.file_names).encode('utf-8')
+    columns_size = sum(len(line_store) * array(typecode).itemsize
+                       for _, typecode in _COMPILED_DECK_COLUMNS)
+    names_offset = _COMPILED_DECK_HEADER.size + columns_size
+    text_offset = names_offset + len(file_names)
+
+    def chunks():
+        yield _COMPILED_DECK_HEADER.pack(b"WGDK", COMPILED_DECK_VERSION,
+                                         len(line_store), names_offset, text_offset)
+        for name, typecode in _COMPILED_DECK_COLUMNS:
+            column = getattr(line_store, name)
+            if column.typecode != typecode:
+                column = array(typecode, column)
+            yield column.tobytes()
+        yield file_names
+        yield line_store.text
+
+    save_data_to_file(chunks(), file_path)
+
+
+class _SideCodes:
+    # Side codes of a mapped deck. Only lines whose side was set are stored,
+    # the others get a fixed pseudo random side from their id.
+    def __init__(self, seed: int):
+        self.seed = seed
+        self.codes = {}
+
+    def __getitem__(self, id: int) -> int:
+        code = self.codes.get(id)
+        if code is None:
+            return ((id * 2654435761 + self.seed) >> 16 & 1) + 1
+        return code
+
+    def __setitem__(self, id: int, code: int):
+        self.codes[id] = code
+
+
+class _SparseAnswers(dict):
+    def __missing__(self, id):
+        return None
+
+
+class MappedDeck(LineStore):
+    # A compiled deck opened with mmap. Every column is a memoryview into the
+    # mapping, so only the pages of lines that are actually read get loaded.
+    def __init__(self, file_path: str):
+        import mmap
+
+        if sys.byteorder != "little":
+            raise OSError("compiled decks need a little endian machine")
+        self.file_path = abspath(file_path)
+        with open(file_path, 'rb') as f:
+            file_stat = fstat(f.fileno())
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # Saved games check they are opening the same file again
+        self.fingerprint = (file_stat.st_mtime_ns, file_stat.st_size)
+        view = memoryview(self._mmap)
+
+        magic, version, count, names_offset, text_offset = \
+            _COMPILED_DECK_HEADER.unpack_from(view)
+        if magic != b"WGDK" or version != COMPILED_DECK_VERSION:
+            raise ValueError(f"{file_path} is not a compiled deck")
+
+        position = _COMPILED_DECK_HEADER.size
+        for name, typecode in _COMPILED_DECK_COLUMNS:
+            size = count * array(typecode).itemsize
+            setattr(self, name, view[position:position + size].cast(typecode))
+            position += size
+
+        file_names = str(view[names_offset:text_offset], 'utf-8')
+        self.file_names = file_names.split("\n") if file_names else []
+        self._file_name_ids = {name: id for id, name in enumerate(self.file_names)}
+        self.text = view[text_offset:]
+        self.sides = _SideCodes(getrandbits(32))
+        self.reloads = 0
+        self._answer_normalization = None
+        self._normalized_answers = None
+
+    def _new_answer_cache(self):
+        # Only the lines that get asked are normalized, a list for every line
+        # would defeat the point of mapping the deck
+        return _SparseAnswers()
+
+    def __reduce__(self):
+        # Pickled by path, a process pool worker maps the file itself
+        return (MappedDeck, (self.file_path,))
+
+    def append(self, *args, **kwargs):
+        raise TypeError("compiled decks are read only")
+
+    def extend_packed(self, *args, **kwargs):
+        raise TypeError("compiled decks are read only")
+
+
+############################# Index permutations
+
+
+class IndexPermutation:
+    # A random permutation of range(length) computed on access instead of
+    # stored: a small Feistel network over the next power of four, repeated
+    # until the value falls inside the range. Slices are views of it. With
+    # a source sequence it yields the source items in permuted order.
+    ROUNDS = 4
+
+    def __init__(self, length: int, keys: tuple = None, start: int = 0,
+                 stop: int = None, source = None):
+        self.length = length
+        self.source = source
+        self.keys = keys if keys is not None else \
+            tuple(getrandbits(32) for _ in range(self.ROUNDS))
+        self.start = start
+        self.stop = length if stop is None else stop
+        self._half_bits = max(1, (max(length - 1, 1).bit_length() + 1) // 2)
+        self._half_mask = (1 << self._half_bits) - 1
+
+    def _permute(self, value: int) -> int:
+        bits, mask = self._half_bits, self._half_mask
+        while True:
+            left, right = value >> bits, value & mask
+            for key in self.keys:
+                left, right = right, left ^ (hash((right, key)) & mask)
+            value = (left << bits) | right
+            if value < self.length:
+                return value
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                raise ValueError("permutation slices can't have a step")
+            return IndexPermutation(self.length, self.keys, self.start + start,
+                                    self.start + max(start, stop), self.source)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("permutation index out of range")
+        if self.source is None:
+            return self._permute(self.start + i)
+        return self.source[self._permute(self.start + i)]
+
+    def __iter__(self):
+        permuted = map(self._permute, range(self.start, self.stop))
+        if self.source is None:
+            return permuted
+        return map(self.source.__getitem__, permuted)
+
+
+def permuted(lines):
+    # Shuffled view of a sequence, nothing is copied
+    if isinstance(lines, range) and lines.start == 0 and lines.step == 1:
+        return IndexPermutation(len(lines))
+    return IndexPermutation(len(lines), source=lines)
+
+
+############################# Answer queue
+
+
+class JoinedIds:
+    # Read-only concatenation of (sequence, start, stop) slices, nothing is
+    # copied. Queues hand out their remaining ids as one so a save does not
+    # build a list of them.
+    def __init__(self, parts):
+        self.parts = []
+        for sequence, start, stop in parts:
+            if stop <= start:
+                continue
+            if isinstance(sequence, JoinedIds):
+                self.parts.extend(sequence[start:stop].parts)
+            else:
+                self.parts.append((sequence, start, stop))
+        self._len = sum(stop - start for _, start, stop in self.parts)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return chain.from_iterable(map(sequence.__getitem__, range(start, stop))
+                                   for sequence, start, stop in self.parts)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                raise ValueError("joined id slices can't have a step")
+            parts = []
+            offset = 0
+            for sequence, part_start, part_stop in self.parts:
+                part_len = part_stop - part_start
+                if start < offset + part_len and stop > offset:
+                    parts.append((sequence, part_start + max(start - offset, 0),
+                                  part_start + min(stop - offset, part_len)))
+                offset += part_len
+            return JoinedIds(parts)
+        if i < 0:
+            i += len(self)
+        if 0 <= i:
+            for sequence, start, stop in self.parts:
+                if i < stop - start:
+                    return sequence[start + i]
+                i -= stop - start
+        raise IndexError("joined id index out of range")
+
+
+class AnswerQueue:
+    # The lines still to answer: a cursor over the lines the queue was built
+    # from, followed by a deque of requeued lines. Advancing and requeueing
+    # are both O(1) and the source sequence is never modified.
+    def __init__(self, lines = ()):
+        self.head = lines
+        self.position = 0
+        self.tail = deque()
+
+    def __len__(self):
+        return len(self.head) - self.position + len(self.tail)
+
+    def __iter__(self):
+        return chain(islice(self.head, self.position, None), self.tail)
+
+    def __getitem__(self, i: int):
+        head_len = len(self.head) - self.position
+        if i < 0:
+            i += len(self)
+        if 0 <= i < head_len:
+            return self.head[self.position + i]
+        return self.tail[i - head_len]
+
+    def popleft(self):
+        if self.position < len(self.head):
+            line = self.head[self.position]
+            self.position += 1
+            if self.position == len(self.head):
+                # Drop the reference so a finished source can be freed
+                self.head = ()
+                self.position = 0
+            return line
+        return self.tail.popleft()
+
+    def append(self, line):
+        self.tail.append(line)
+
+    def to_list(self) -> list:
+        return list(self)
+
+    def view(self) -> JoinedIds:
+        # The remaining lines, only the requeued ones are copied
+        return JoinedIds([(self.head, self.position, len(self.head)),
+                          (list(self.tail), 0, len(self.tail))])
+
+    def peek(self, count: int) -> list:
+        return list(islice(self, count))
+
+    def patch(self, replaced: dict, removed: set, added = ()):
+        lines = [replaced.get(line, line) for line in self if line not in removed]
+        lines.extend(added)
+        self.head = lines
+        self.position = 0
+        self.tail = deque()
+
+    def shuffle(self):
+        if self.tail:
+            lines = self.to_list()
+            shuffle(lines)
+        else:
+            lines = permuted(self.head[self.position:])
+        self.head = lines
+        self.position = 0
+        self.tail = deque()
+
+    def state(self):
+        return None
+
+
+class SpacedRepetitionQueue:
+    # Leitner boxes counted in turns. Lines come from the source in order,
+    # an answered line goes into a heap keyed on the turn it is due again:
+    # a mistake drops it to box 0 and brings it back after one other line,
+    # a right answer moves it up a box and doubles its interval. Lines leave
+    # the queue once they pass the last box. Due lines are asked before new
+    # ones, so picking the next line is O(log n) and never scans the deck.
+    always_requeue = True
+
+    def __init__(self, lines = (), boxes: int = 3, interval: int = 4,
+                 state: dict = None):
+        self.boxes = boxes
+        self.interval = interval
+        self.turn = 0
+        self.head = lines
+        self.position = 0
+        # [due turn, order, box, line], order keeps equal turns first in first out
+        self.heap = []
+        self._order = 0
+        self._front_failed = False
+        if state is not None:
+            self._restore(state)
+
+    def _restore(self, state: dict):
+        # state["cards"] lines up with the first lines the queue was built
+        # from, the lines after them were never asked. A None card also
+        # marks a line never asked.
+        self.turn = state["turn"]
+        asked = 0
+        for card in state["cards"]:
+            if card is None or asked >= len(self.head):
+                break
+            due, box = card
+            self.heap.append([due, self._order, box, self.head[asked]])
+            self._order += 1
+            asked += 1
+        heapify(self.heap)
+        self.head = self.head[asked:]
+
+    def _front_is_new(self) -> bool:
+        if self.heap and self.heap[0][0] <= self.turn:
+            return False
+        return self.position < len(self.head)
+
+    def __len__(self):
+        return len(self.head) - self.position + len(self.heap)
+
+    def __getitem__(self, i: int):
+        if i == 0:
+            if self._front_is_new():
+                return self.head[self.position]
+            if not self.heap:
+                raise IndexError("queue is empty")
+            return self.heap[0][3]
+        return self.to_list()[i]
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def popleft(self):
+        if self._front_is_new():
+            line = self.head[self.position]
+            self.position += 1
+            box = 0
+        else:
+            _, _, box, line = heappop(self.heap)
+        self.turn += 1
+
+        if self._front_failed:
+            self._front_failed = False
+            self._push(self.turn + 1, 0, line)
+        elif box + 1 < self.boxes:
+            self._push(self.turn + self.interval * 2 ** box, box + 1, line)
+        return line
 
-    return file_list
+    def _push(self, due: int, box: int, line):
+        heappush(self.heap, [due, self._order, box, line])
+        self._order += 1
+
+    def append(self, line):
+        # Called with the front line when it was answered wrong, popleft
+        # then puts it back into box 0
+        self._front_failed = True
+
+    def to_list(self) -> list:
+        return [card[3] for card in sorted(self.heap)] + \
+            list(islice(self.head, self.position, None))
+
+    def _due_cards(self, count: int, last_turn: int):
+        # Up to count cards due by last_turn, soonest first. The heap is walked
+        # from the root with a small heap of children, O(count log count)
+        # however many cards there are.
+        heap = self.heap
+        frontier = [(heap[0], 0)] if heap else []
+        while frontier and count > 0:
+            card, i = heappop(frontier)
+            if card[0] > last_turn:
+                break
+            yield card
+            count -= 1
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(heap):
+                    heappush(frontier, (heap[child], child))
+
+    def peek(self, count: int) -> list:
+        # The front line, then a guess at the next ones if every answer is
+        # right: cards due within count turns first, then new lines
+        if len(self) == 0 or count <= 0:
+            return []
+        front = self[0]
+        lines = [card[3] for card in self._due_cards(count, self.turn + count)]
+        lines += islice(self.head, self.position, self.position + count)
+        # With no new lines left the front can be a card not due yet
+        if front in lines:
+            lines.remove(front)
+        return [front] + lines[:count - 1]
+
+    def patch(self, replaced: dict, removed: set, added = ()):
+        # Cards keep their box and due turn, added lines are new cards
+        self.heap = [[due, order, box, replaced.get(line, line)]
+                     for due, order, box, line in self.heap if line not in removed]
+        heapify(self.heap)
+        new_lines = [replaced.get(line, line)
+                     for line in islice(self.head, self.position, None)
+                     if line not in removed]
+        new_lines.extend(added)
+        self.head = new_lines
+        self.position = 0
+
+    def shuffle(self):
+        new_lines = list(islice(self.head, self.position, None))
+        shuffle(new_lines)
+        self.head = new_lines
+        self.position = 0
+
+    def view(self) -> JoinedIds:
+        # Lines asked before, soonest due first, then the new ones. Only the
+        # asked lines are copied.
+        asked = [card[3] for card in sorted(self.heap)]
+        return JoinedIds([(asked, 0, len(asked)),
+                          (self.head, self.position, len(self.head))])
+
+    def state(self) -> dict:
+        # Cards of the lines asked before, in the order of view()
+        return {"turn": self.turn,
+                "cards": [[card[0], card[2]] for card in sorted(self.heap)]}
+
+
+def make_answer_queue(lines, settings: dict, state: dict = None):
+    if settings.get("spaced_repetition", False) == True:
+        return SpacedRepetitionQueue(lines, settings.get("leitner_boxes", 3),
+                                     settings.get("leitner_interval", 4), state)
+    return AnswerQueue(lines)
 
 
 ############################# Game engine
 
 
 class GameEngine:
+    # The queue holds ids into self.line_store, get_curent_line returns a
+    # StoredLine view of the current one
     def __init__(self, game_data: dict):
-        self.mistake_count: int = game_data["mistake_count"]
-        self.current_line: int = game_data["current_line"]
-        self.remaining_lines: List[Line] = game_data["remaining_lines"]
-        self.original_lines_len = len(self.remaining_lines)
-        self.settings = game_data["settings"]
+        self.extract_self_from_game_data(game_data)
 
     def extract_self_from_game_data(self, game_data: dict):
         self.mistake_count: int = game_data["mistake_count"]
         self.current_line: int = game_data["current_line"]
-        self.remaining_lines: List[Line] = game_data["remaining_lines"]
-        self.original_lines_len = len(self.remaining_lines)
         self.settings = game_data["settings"]
+        self.line_store, line_ids = game_data_line_store(game_data)
+        self.set_lines(line_ids, game_data.get("queue_state"))
+        # Answers, mistakes and answer time per line id, kept across batches
+        self.line_attempts = Counter()
+        self.line_mistakes = Counter()
+        self.line_latency_ns = Counter()
+        self._shown_at = perf_counter_ns()
 
     def extract_game_data_from_self(self) -> dict:
         gd = get_default_game_data()
         gd["mistake_count"] = self.mistake_count
         gd["current_line"] = self.current_line
-        gd["remaining_lines"] = self.remaining_lines
+        gd["remaining_lines"] = self.remaining_lines.view()
+        gd["queue_state"] = self.remaining_lines.state()
+        gd["line_store"] = self.line_store
         gd["settings"] = self.settings
         return gd
 
+    def set_lines(self, line_ids, queue_state: dict = None):
+        self.remaining_lines = make_answer_queue(line_ids, self.settings, queue_state)
+        self.original_lines_len = len(line_ids)
+
+    def patch_lines(self, replaced: dict, removed: set, added = ()):
+        # Applies a deck reload to the queue in place, the mistakes and
+        # answers of an edited line carry over to its new id
+        queue_len = len(self.remaining_lines)
+        self.remaining_lines.patch(replaced, removed, added)
+        dropped = queue_len + len(added) - len(self.remaining_lines)
+        self.original_lines_len = max(self.original_lines_len + len(added) - dropped, 1)
+        for counter in (self.line_attempts, self.line_mistakes, self.line_latency_ns):
+            for old_id, new_id in replaced.items():
+                if old_id in counter:
+                    counter[new_id] += counter.pop(old_id)
+
     def shuffle_with_check(self):
         if self.settings["random_line_post_batch"] == True:
-            shuffle(self.remaining_lines)
+            self.remaining_lines.shuffle()
     
     def len_check(self):
         if len(self.remaining_lines) <= 0:
@@ -273,138 +2216,903 @@ class GameEngine:
 
     def _step_forward(self):
         self.current_line += 1
-        self.remaining_lines.pop(0)
+        self.remaining_lines.popleft()
         # False = End of game
         # True = Game is ongoing
         return self.len_check()
     
     def _mistake(self):
         self.mistake_count += 1
-        if self.settings["only_once"] == False:
-            self.remaining_lines.append(self.get_curent_line())
+        self.line_mistakes[self.remaining_lines[0]] += 1
+        if self.settings["only_once"] == False or \
+                getattr(self.remaining_lines, "always_requeue", False):
+            self.remaining_lines.append(self.remaining_lines[0])
 
-    def get_curent_line(self):
-        return self.remaining_lines[0]
+    def get_curent_line(self) -> StoredLine:
+        return self.line_store[self.remaining_lines[0]]
     
     def get_lines_len(self):
             return len(self.remaining_lines)
     
+    def line_shown(self):
+        # Called when the current line is put in front of the player, the
+        # time until the answer is kept for the line
+        self._shown_at = perf_counter_ns()
+
     def _answer_handle(self, user_input, correct_answer_side):
+        now = perf_counter_ns()
+        self.line_attempts[self.remaining_lines[0]] += 1
+        self.line_latency_ns[self.remaining_lines[0]] += now - self._shown_at
+        self._shown_at = now
         if user_input != correct_answer_side: #Incorect answer
             self._mistake()           
 
         return self._step_forward()
 
     def progress_game_typing_mode(self, user_input = ""):
-        line_current = self.get_curent_line()
-        side_answer: str = line_current.side_as_string(line_current.side_answer, False)
+        line_id = self.remaining_lines[0]
+        normalization = answer_normalization(self.settings)
+        side_answer: str = self.line_store.normalized_answer(
+            line_id, self.line_store[line_id].side_answer, normalization)
+        user_input = normalize_answer(user_input, *normalization)
 
-        if self.settings["case_senstive"] == False:
-            side_answer = side_answer.lower()
-            user_input = user_input.lower()
-        if self.settings["white_space_senstive"] == False:
-            side_answer = ''.join(side_answer.split())
-            user_input = ''.join(user_input.split())
+        typo_tolerance = self.settings.get("typo_tolerance", 0)
+        if typo_tolerance > 0 and user_input != side_answer and \
+                within_edit_distance(user_input, side_answer, typo_tolerance):
+            user_input = side_answer
 
         return self._answer_handle(user_input, side_answer)
 
     def progress_game_simple_mode(self, user_input = ""):
         return self._answer_handle(user_input, "")
 
+    def progress_game_choice_mode(self, choice: str = ""):
+        # choice is the text of the picked option, unlike typing mode a near
+        # miss is wrong since the distractors can be near misses themselves
+        line_id = self.remaining_lines[0]
+        normalization = answer_normalization(self.settings)
+        side_answer: str = self.line_store.normalized_answer(
+            line_id, self.line_store[line_id].side_answer, normalization)
+        return self._answer_handle(normalize_answer(choice, *normalization), side_answer)
+
 
 ############################# Game history
 
 
-game_history = load_game_data_list(DEFAULT_GAME_HISTORY_PATH)
+class GameHistory:
+    # Finished games in an sqlite database, one row per game and one per line
+    # asked in it. The connection is only opened on first use.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS games (
+            id INTEGER PRIMARY KEY,
+            finished_at TEXT NOT NULL,
+            deck TEXT,
+            lines_len INTEGER NOT NULL,
+            mistake_count INTEGER NOT NULL,
+            score REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS games_finished_at ON games (finished_at);
+        CREATE INDEX IF NOT EXISTS games_deck ON games (deck);
+        CREATE TABLE IF NOT EXISTS game_lines (
+            game_id INTEGER NOT NULL REFERENCES games (id),
+            file TEXT,
+            line_index INTEGER,
+            left TEXT NOT NULL,
+            right TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            mistakes INTEGER NOT NULL,
+            latency_ms REAL
+        );
+        CREATE INDEX IF NOT EXISTS game_lines_game ON game_lines (game_id);
+        CREATE INDEX IF NOT EXISTS game_lines_file ON game_lines (file);
+        CREATE INDEX IF NOT EXISTS game_lines_identity ON game_lines (file, line_index);
+    """
+
+    def __init__(self, file_path: str = DEFAULT_GAME_HISTORY_PATH):
+        self.file_path = file_path
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            import sqlite3
+            # The server records games from its own history thread
+            self._connection = sqlite3.connect(self.file_path, check_same_thread=False)
+            self._connection.executescript(self.SCHEMA)
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def record_game(self, game_engine: GameEngine, lines_len: int,
+                    deck: str = None, line_ids = None) -> int:
+        # line_ids defaults to every line in the engine store
+        if line_ids is None:
+            line_ids = range(len(game_engine.line_store))
+        mistake_count = game_engine.mistake_count
+        score = get_score_percent(mistake_count, lines_len) if lines_len > 0 else 100.0
+        line_store = game_engine.line_store
+        with self.connection as connection:
+            cursor = connection.execute(
+                "INSERT INTO games (finished_at, deck, lines_len, mistake_count, score) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (datetime.now().isoformat(timespec="seconds"), deck, lines_len,
+                 mistake_count, score))
+            game_id = cursor.lastrowid
+            connection.executemany(
+                "INSERT INTO game_lines (game_id, file, line_index, left, right, "
+                "attempts, mistakes, latency_ms) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ((game_id, line_store.get_file(id), line_store.indices[id],
+                  line_store.get_left(id), line_store.get_right(id),
+                  game_engine.line_attempts[id], game_engine.line_mistakes[id],
+                  game_engine.line_latency_ns[id] / 10**6)
+                 for id in line_ids))
+        return game_id
+
+    def count_games(self, deck: str = None) -> int:
+        if deck is None:
+            row = self.connection.execute("SELECT COUNT(*) FROM games").fetchone()
+        else:
+            row = self.connection.execute(
+                "SELECT COUNT(*) FROM games WHERE deck = ?", (deck,)).fetchone()
+        return row[0]
+
+    def list_games(self, page: int = 0, per_page: int = 20,
+                   deck: str = None) -> List[tuple]:
+        # Newest first: (id, finished_at, deck, lines_len, mistake_count, score)
+        query = "SELECT id, finished_at, deck, lines_len, mistake_count, score FROM games"
+        parameters = []
+        if deck is not None:
+            query += " WHERE deck = ?"
+            parameters.append(deck)
+        query += " ORDER BY finished_at DESC, id DESC LIMIT ? OFFSET ?"
+        parameters += [per_page, page * per_page]
+        return self.connection.execute(query, parameters).fetchall()
+
+    def deck_summary(self) -> List[tuple]:
+        # (deck, games, average score, best score, last played)
+        return self.connection.execute(
+            "SELECT deck, COUNT(*), AVG(score), MAX(score), MAX(finished_at) "
+            "FROM games GROUP BY deck ORDER BY MAX(finished_at) DESC").fetchall()
+
+    def hardest_lines(self, limit: int = 20, deck: str = None,
+                      file: str = None) -> List[tuple]:
+        # (deck, file, line_index, left, right, attempts, mistakes) most
+        # missed first. File names only tell lines apart within a deck.
+        query = ("SELECT games.deck, file, line_index, left, right, SUM(attempts), "
+                 "SUM(mistakes) FROM game_lines JOIN games ON games.id = game_id")
+        conditions, parameters = [], []
+        if deck is not None:
+            conditions.append("games.deck = ?")
+            parameters.append(deck)
+        if file is not None:
+            conditions.append("file = ?")
+            parameters.append(file)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += (" GROUP BY games.deck, file, line_index HAVING SUM(mistakes) > 0 "
+                  "ORDER BY SUM(mistakes) DESC, SUM(attempts) DESC LIMIT ?")
+        parameters.append(limit)
+        return self.connection.execute(query, parameters).fetchall()
+
+
+############################# Line statistics
+
+
+class LineStats:
+    # Attempts, mistakes and answer time of every line in the game history,
+    # summed into numpy arrays with one slot per line identity (deck, file,
+    # line index). update() reads only the game_lines rows added since it last
+    # ran and merges them in one vectorized pass, queries never loop over
+    # games or lines in Python. numpy is imported on first use.
+    def __init__(self, history: GameHistory):
+        self.history = history
+        self.decks = None
+        self.files = None
+        self.indices = None
+        self.attempts = None
+        self.mistakes = None
+        # Answer time only counts attempts of games that kept it
+        self.timed_attempts = None
+        self.latency_ms = None
+        # Newest game_lines row of every slot, its text is shown for the line
+        self.last_rows = None
+        self.last_rowid = 0
+
+    def __len__(self):
+        return 0 if self.files is None else len(self.files)
+
+    def update(self) -> int:
+        # Merges the new history rows, returns how many there were
+        import numpy as np
+
+        rows = self.history.connection.execute(
+            "SELECT game_lines.rowid, COALESCE(games.deck, ''), COALESCE(file, ''), "
+            "COALESCE(line_index, -1), attempts, mistakes, "
+            "CASE WHEN latency_ms IS NULL THEN 0 ELSE attempts END, COALESCE(latency_ms, 0) "
+            "FROM game_lines JOIN games ON games.id = game_id "
+            "WHERE game_lines.rowid > ? ORDER BY game_lines.rowid",
+            (self.last_rowid,)).fetchall()
+        if not rows:
+            return 0
+        rowids, decks, files, indices, attempts, mistakes, timed_attempts, latency_ms = zip(*rows)
+        columns = [np.array(decks, dtype=object), np.array(files, dtype=object),
+                   np.array(indices, dtype=np.int64),
+                   np.array(attempts, dtype=np.int64), np.array(mistakes, dtype=np.int64),
+                   np.array(timed_attempts, dtype=np.int64),
+                   np.array(latency_ms, dtype=np.float64), np.array(rowids, dtype=np.int64)]
+        if self.files is not None:
+            # The slots so far go in as one row each
+            old_columns = [self.decks, self.files, self.indices, self.attempts,
+                           self.mistakes, self.timed_attempts, self.latency_ms,
+                           self.last_rows]
+            columns = [np.concatenate(pair) for pair in zip(old_columns, columns)]
+        decks, files, indices, attempts, mistakes, timed_attempts, latency_ms, rowids = columns
+
+        # The same file name in two decks is two different files
+        _, deck_ids = np.unique(decks, return_inverse=True)
+        _, file_ids = np.unique(files, return_inverse=True)
+        _, deck_file_ids = np.unique(deck_ids.astype(np.int64) * (file_ids.max() + 1)
+                                     + file_ids, return_inverse=True)
+        keys = (deck_file_ids.astype(np.int64) << 32) | (indices & 0xffffffff)
+        _, first, slots = np.unique(keys, return_index=True, return_inverse=True)
+        slot_count = len(first)
+
+        def summed(values):
+            return np.bincount(slots, weights=values, minlength=slot_count)
+
+        self.decks = decks[first]
+        self.files = files[first]
+        self.indices = indices[first]
+        self.attempts = summed(attempts).astype(np.int64)
+        self.mistakes = summed(mistakes).astype(np.int64)
+        self.timed_attempts = summed(timed_attempts).astype(np.int64)
+        self.latency_ms = summed(latency_ms)
+        self.last_rows = np.zeros(slot_count, dtype=np.int64)
+        np.maximum.at(self.last_rows, slots, rowids)
+        self.last_rowid = rows[-1][0]
+        return len(rows)
+
+    def mean_latency_ms(self):
+        # Per slot, nan for lines never timed
+        import numpy as np
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(self.timed_attempts > 0,
+                            self.latency_ms / self.timed_attempts, np.nan)
+
+    def hardest(self, limit: int = 50, deck: str = None,
+                file: str = None) -> List[tuple]:
+        # (deck, file, line_index, left, right, attempts, mistakes, mean
+        # answer ms) hardest first. Lines are ranked on their mistake rate counting one
+        # extra right and wrong answer, so a single miss in a single try
+        # does not outrank a line missed in half of fifty tries.
+        import numpy as np
+
+        self.update()
+        if len(self) == 0 or limit <= 0:
+            return []
+        candidates = self.mistakes > 0
+        if deck is not None:
+            candidates &= self.decks == deck
+        if file is not None:
+            candidates &= self.files == file
+        candidates = np.flatnonzero(candidates)
+        rate = (self.mistakes[candidates] + 1) / (self.attempts[candidates] + 2)
+        if len(candidates) > limit:
+            kept = np.argpartition(-rate, limit - 1)[:limit]
+            candidates, rate = candidates[kept], rate[kept]
+        order = np.lexsort((-self.mistakes[candidates], -rate))
+        top = candidates[order]
+
+        latency = self.mean_latency_ms()
+        last_rows = self.last_rows[top].tolist()
+        texts = dict((rowid, (left, right)) for rowid, left, right in
+                     self.history.connection.execute(
+                         "SELECT rowid, left, right FROM game_lines WHERE rowid IN "
+                         f"({', '.join('?' * len(last_rows))})", last_rows))
+        return [(self.decks[slot] or None, self.files[slot] or None,
+                 int(self.indices[slot]), *texts[rowid],
+                 int(self.attempts[slot]), int(self.mistakes[slot]),
+                 None if np.isnan(latency[slot]) else float(latency[slot]))
+                for slot, rowid in zip(top.tolist(), last_rows)]
+
+    def score_trend(self, recent: int = 5) -> List[tuple]:
+        # (deck, games, average score, average of the last `recent` games,
+        # score change per game) for every deck, most played first. The
+        # change per game is the slope of a least squares line through the
+        # scores of the deck in the order its games were played.
+        import numpy as np
+
+        rows = self.history.connection.execute(
+            "SELECT COALESCE(deck, ''), score FROM games ORDER BY finished_at, id").fetchall()
+        if not rows:
+            return []
+        decks, scores = zip(*rows)
+        deck_names, deck_ids = np.unique(np.array(decks, dtype=object), return_inverse=True)
+        scores = np.array(scores, dtype=np.float64)
+
+        # Position of every game among the games of its deck
+        games = np.bincount(deck_ids)
+        order = np.argsort(deck_ids, kind="stable")
+        positions = np.empty(len(scores), dtype=np.float64)
+        positions[order] = np.arange(len(scores)) - np.repeat(np.cumsum(games) - games, games)
+
+        def summed(values):
+            return np.bincount(deck_ids, weights=values, minlength=len(deck_names))
+
+        sum_x, sum_y = summed(positions), summed(scores)
+        sum_xx, sum_xy = summed(positions * positions), summed(positions * scores)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope = (games * sum_xy - sum_x * sum_y) / (games * sum_xx - sum_x * sum_x)
+        slope = np.where(games > 1, slope, 0.0)
+        is_recent = positions >= (games - recent)[deck_ids]
+        recent_average = summed(np.where(is_recent, scores, 0)) / np.minimum(games, recent)
+
+        return [(deck_names[i] or None, int(games[i]), float(sum_y[i] / games[i]),
+                 float(recent_average[i]), float(slope[i]))
+                for i in np.argsort(-games, kind="stable").tolist()]
+
+
+
+
+############################# Session store
+
+
+class SessionStore:
+    # Saved games in an sqlite database, one row per game with its metadata
+    # in columns and the game itself packed by pack_game_data. A game is only read when it is
+    # asked for by id and the last used ones stay parsed in a LRU cache.
+    # Changes go into the cache and are written when a game falls out of it
+    # or on flush(), listing saves only reads the metadata columns. An answer
+    # given in a saved game is only logged as a row of the answers table,
+    # reading the game replays its answers and a game with FOLD_AFTER of
+    # them is written again in one row.
+    ANSWERS_PER_WRITE = 20
+    FOLD_AFTER = 500
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS saves (
+            id INTEGER PRIMARY KEY,
+            saved_at TEXT NOT NULL,
+            deck TEXT,
+            remaining INTEGER NOT NULL,
+            current_line INTEGER NOT NULL,
+            mistake_count INTEGER NOT NULL,
+            data BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS answers (
+            game_id INTEGER NOT NULL,
+            mistake INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS answers_game_id ON answers (game_id);
+    """
+
+    def __init__(self, file_path: str = DEFAULT_GAME_SAVES_PATH,
+                 cache_size: int = 8, legacy_path: str = None):
+        # Games saved in legacy_path by older versions are moved into an
+        # empty store when it is first opened, the old files are left as is
+        self.file_path = file_path
+        self.cache_size = max(cache_size, 1)
+        self.legacy_path = legacy_path
+        self._connection = None
+        # id -> [game data, deck, changed since written]
+        self._cache = OrderedDict()
+        # (id, mistake) of the answers not written yet, and the counts of
+        # their games after them
+        self._answers = []
+        self._progress = {}
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            import sqlite3
+            self._connection = sqlite3.connect(self.file_path)
+            self._connection.executescript(self.SCHEMA)
+            self._migrate()
+        return self._connection
+
+    def _migrate(self):
+        # The json list of games older versions saved
+        if self.legacy_path is None or not exists(self.legacy_path) or self.count() > 0:
+            return
+        with self._connection as connection:
+            for id, gd in enumerate(load_game_data_list(self.legacy_path)):
+                self._write(connection, id, gd, None)
+
+    @staticmethod
+    def _write(connection, id: int, game_data: dict, deck: str):
+        connection.execute(
+            "INSERT OR REPLACE INTO saves (id, saved_at, deck, remaining, "
+            "current_line, mistake_count, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (id, datetime.now().isoformat(timespec="seconds"), deck,
+             len(game_data["remaining_lines"]), game_data["current_line"],
+             game_data["mistake_count"], pack_game_data(game_data)))
+        connection.execute("DELETE FROM answers WHERE game_id = ?", (id,))
+
+    def _write_changed(self, connection):
+        for id, entry in self._cache.items():
+            if entry[2]:
+                self._write(connection, id, entry[0], entry[1])
+                entry[2] = False
+
+    def _write_answers(self, connection):
+        # A game changed since it was written is written first, its answers
+        # come after that copy
+        for id in self._progress:
+            entry = self._cache.get(id)
+            if entry is not None and entry[2]:
+                self._write(connection, id, entry[0], entry[1])
+                entry[2] = False
+        connection.executemany("INSERT INTO answers (game_id, mistake) VALUES (?, ?)",
+                               self._answers)
+        saved_at = datetime.now().isoformat(timespec="seconds")
+        connection.executemany(
+            "UPDATE saves SET saved_at = ?, remaining = ?, current_line = ?, "
+            "mistake_count = ? WHERE id = ?",
+            [(saved_at, *progress, id) for id, progress in self._progress.items()])
+        self._answers = []
+        self._progress = {}
+
+    @staticmethod
+    def _replay(game_data: dict, mistakes: list) -> dict:
+        # The game after the answers logged for it, taken the way the game
+        # took them
+        game_engine = GameEngine(dict(game_data))
+        for mistake in mistakes:
+            if not game_engine.len_check():
+                break
+            if mistake:
+                game_engine._mistake()
+            game_engine._step_forward()
+        return game_engine.extract_game_data_from_self()
+
+    def _touch(self, id: int, entry: list):
+        self._cache[id] = entry
+        self._cache.move_to_end(id)
+        while len(self._cache) > self.cache_size:
+            cold_id, (game_data, deck, changed) = self._cache.popitem(last=False)
+            if changed:
+                with self.connection as connection:
+                    self._write(connection, cold_id, game_data, deck)
+
+    def count(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM saves").fetchone()[0]
+
+    def list_saves(self, page: int = 0, per_page: int = 20) -> List[tuple]:
+        # Newest first: (id, saved_at, deck, remaining, current_line, mistake_count)
+        self.flush()
+        return self.connection.execute(
+            "SELECT id, saved_at, deck, remaining, current_line, mistake_count "
+            "FROM saves ORDER BY id DESC LIMIT ? OFFSET ?",
+            (per_page, page * per_page)).fetchall()
+
+    def get(self, id: int) -> dict:
+        # The saved game data, None when there is no game with this id
+        entry = self._cache.get(id)
+        if entry is None:
+            row = self.connection.execute(
+                "SELECT data, deck FROM saves WHERE id = ?", (id,)).fetchone()
+            if row is None:
+                return None
+            entry = [unpack_game_data(row[0])[0], row[1], False]
+        mistakes = [mistake for answer_id, mistake in self._answers if answer_id == id]
+        if not entry[2]:
+            # The game is still the one in its row, the answers logged after
+            # it come first
+            mistakes[:0] = [mistake == 1 for (mistake,) in self.connection.execute(
+                "SELECT mistake FROM answers WHERE game_id = ? ORDER BY rowid", (id,))]
+        if mistakes:
+            # Folded into the row right away, answers logged from now on go
+            # after it
+            self._drop_answers(id)
+            entry = [self._replay(entry[0], mistakes), entry[1], False]
+            with self.connection as connection:
+                self._write(connection, id, entry[0], entry[1])
+        self._touch(id, entry)
+        return dict(entry[0])
+
+    def deck(self, id: int) -> str:
+        entry = self._cache.get(id)
+        if entry is not None:
+            return entry[1]
+        row = self.connection.execute(
+            "SELECT deck FROM saves WHERE id = ?", (id,)).fetchone()
+        return None if row is None else row[0]
+
+    def add(self, game_data: dict, deck: str = None) -> int:
+        # New games are written right away, that reserves their id
+        with self.connection as connection:
+            id = connection.execute(
+                "SELECT COALESCE(MAX(id) + 1, 0) FROM saves").fetchone()[0]
+            self._write(connection, id, game_data, deck)
+        self._touch(id, [game_data, deck, False])
+        return id
+
+    def put(self, id: int, game_data: dict, deck: str = None):
+        self._drop_answers(id)
+        self._touch(id, [game_data, deck, True])
+
+    def answered(self, id: int, mistake: bool, remaining: int, current_line: int,
+                 mistake_count: int):
+        # Logs an answer given in the game saved as id, the counts are the
+        # ones of the game after it. Answers are written every
+        # ANSWERS_PER_WRITE of them and on flush().
+        self._answers.append((id, mistake))
+        self._progress[id] = (remaining, current_line, mistake_count)
+        if len(self._answers) >= self.ANSWERS_PER_WRITE:
+            with self.connection as connection:
+                self._write_answers(connection)
+
+    def _drop_answers(self, id: int):
+        # Answers not written yet that a newer copy of the game already has
+        if id in self._progress:
+            self._answers = [answer for answer in self._answers if answer[0] != id]
+            del self._progress[id]
+
+    def iter_games(self):
+        self.flush()
+        for (id,) in self.connection.execute("SELECT id FROM saves ORDER BY id").fetchall():
+            yield self.get(id)
+
+    def flush(self):
+        with self.connection as connection:
+            self._write_changed(connection)
+            self._write_answers(connection)
+        folded = self.connection.execute(
+            "SELECT game_id FROM answers GROUP BY game_id HAVING COUNT(*) >= ?",
+            (self.FOLD_AFTER,)).fetchall()
+        for (id,) in folded:
+            self.get(id)
+
+    def close(self):
+        self.flush()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+############################# Autosave
+
+
+class Autosaver:
+    # Keeps a snapshot of the running game in an autosave file, taken every
+    # every_answers answers or every_seconds seconds (0 turns either off).
+    # The turn only takes the small state of the engine; a background thread
+    # reads the lines from the store, packs the game and writes it through
+    # save_data_to_file. A snapshot still waiting is replaced by a newer one,
+    # one the deck was reloaded under is dropped and taken again on the next
+    # answer. Failures are kept in errors.
+    def __init__(self, file_path: str = DEFAULT_AUTOSAVE_PATH,
+                 every_answers: int = 20, every_seconds: float = 30):
+        self.file_path = file_path
+        self.every_answers = every_answers
+        self.every_seconds = every_seconds
+        self.errors: List[Exception] = []
+        self._answers = 0
+        self._last_snapshot = perf_counter_ns()
+        self._pending: tuple = None
+        self._retake = False
+        self._writing = False
+        self._condition = threading.Condition()
+        self._thread: threading.Thread = None
+
+    def answered(self, game_master: "GameMaster"):
+        self._answers += 1
+        due = self._retake or \
+            self.every_answers > 0 and self._answers >= self.every_answers
+        if not due and self.every_seconds > 0:
+            due = perf_counter_ns() - self._last_snapshot >= self.every_seconds * 10**9
+        if due:
+            self.snapshot(game_master)
+
+    def snapshot(self, game_master: "GameMaster"):
+        self._answers = 0
+        self._retake = False
+        self._last_snapshot = perf_counter_ns()
+        snapshot = _save_parts(game_master.game_engine.extract_game_data_from_self(),
+                               {"id": game_master.game_id, "deck": game_master.deck})
+        with self._condition:
+            self._pending = snapshot
+            self._condition.notify_all()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._write_pending,
+                                                name="autosave", daemon=True)
+                self._thread.start()
+
+    def _write_pending(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                snapshot, self._pending = self._pending, None
+                self._writing = True
+            try:
+                data = _pack_save_parts(snapshot)
+                if _save_parts_stale(snapshot):
+                    self._retake = True
+                else:
+                    save_data_to_file(data, self.file_path)
+            except Exception as e:
+                self.errors.append(e)
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+    def wait(self):
+        # Blocks until every snapshot taken so far is written
+        with self._condition:
+            while self._pending is not None or self._writing:
+                self._condition.wait()
+
+    def pop_errors(self) -> List[Exception]:
+        errors, self.errors = self.errors, []
+        return errors
+
+    def load(self) -> dict:
+        # The last snapshot written, None when there is none
+        try:
+            with open(self.file_path, 'rb') as f:
+                data = f.read()
+            game, info = unpack_game_data(data)
+        except Exception as e:
+            return None
+        return {"id": info["id"], "deck": info["deck"], "game": game}
+
+    def discard(self):
+        # Called once the snapshot is no longer needed: the game was saved
+        # or finished
+        with self._condition:
+            self._pending = None
+        self.wait()
+        self._answers = 0
+        self._last_snapshot = perf_counter_ns()
+        if exists(self.file_path):
+            remove(self.file_path)
 
 
 ############################# Game Master
 
-def divide_into_batches(lines: List[Line], batch_size: int) -> List[List[Line]]:
-    batches = []
-    for i in range(0, len(lines), batch_size):
-        batches.append(lines[i:i + batch_size])
-    return batches
+class BatchView:
+    # Batches of a line sequence, a batch is only sliced out when it is used.
+    # The first `played` batches are already done and not kept.
+    def __init__(self, lines, batch_size: int, played: int = 0):
+        self.lines = lines
+        self.batch_size = batch_size
+        self.played = played
+
+    def __len__(self):
+        return self.played - (-len(self.lines) // self.batch_size)
+
+    def __getitem__(self, i: int):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("batch index out of range")
+        if i < self.played:
+            raise IndexError("batch was already played")
+        i -= self.played
+        return self.lines[i * self.batch_size:(i + 1) * self.batch_size]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def divide_into_batches(lines, batch_size: int) -> BatchView:
+    return BatchView(lines, batch_size)
 
 class GameMaster:
-    def __init__(self, game_saves_path=DEFAULT_GAME_SAVES_PATH):
-        self.past_game_data_list = load_game_data_list(game_saves_path)
+    def __init__(self, game_saves_path=DEFAULT_GAME_SAVES_PATH,
+                 history: GameHistory = None, session_cache_size: int = 8,
+                 autosaver: Autosaver = None):
+        # Finished games are recorded into history when one is given, the
+        # running one is autosaved when an autosaver is given
+        self.history = history
+        self.autosaver = autosaver
+        self.deck: str = None
+        self.game_line_ids = []
+        self.sessions = None
+        if game_saves_path != None and game_saves_path != "":
+            self.sessions = SessionStore(game_saves_path, session_cache_size,
+                                         splitext(game_saves_path)[0] + ".json")
         self.game_id = None
+        # Whether the copy of the game in the session store lines up with the
+        # engine, answers are then logged to it instead of saving the game
+        self.stored_current = False
         self.game_data_batch_list = []
         self.batch_in_use = None
         self.game_engine: GameEngine
         self.game_state = False
 
     def new_game_from_data(self, game_data: dict):
-        gdrl = game_data["remaining_lines"] 
-        if game_data["settings"]["random_line_pre_batch"]:
-            shuffle(gdrl)
-        if game_data["settings"]["batch_mode"] == True:
+        # Batches are lazy views of line ids, the lines themselves stay in the
+        # store and nothing is copied until a batch is played
+        line_store, gdrl = game_data_line_store(game_data)
+        # A saved queue state lines up with the saved order of the lines
+        resumed = game_data.get("queue_state") is not None
+        if game_data["settings"]["random_line_pre_batch"] and not resumed:
+            gdrl = permuted(gdrl)
+        if game_data["settings"]["batch_mode"] == True and not resumed:
             self.game_data_batch_list = \
             divide_into_batches(gdrl,
                                 game_data["settings"]["batch_size"])
         else:
-            self.game_data_batch_list = [game_data["remaining_lines"]]
+            self.game_data_batch_list = [gdrl]
+        self.game_line_ids = gdrl
         self.batch_in_use = 0
         game_data["remaining_lines"] = self.game_data_batch_list[0]
+        game_data["line_store"] = line_store
         self.game_engine = GameEngine(game_data)
         return self.game_engine
 
-    def new_game(self, lines: List[Line] = [], settings = None):
+    def new_game(self, lines = [], settings = None, deck: str = None,
+                 line_ids = None):
+        # line_ids picks the lines of a LineStore to play, all by default
+        self.deck = deck
+        self.game_id = None
         game_data = get_default_game_data()
         if settings != None:
             game_data["settings"] = settings
-        game_data["remaining_lines"] = lines
+        if line_ids is not None:
+            game_data["line_store"] = lines
+            game_data["remaining_lines"] = line_ids
+        else:
+            game_data["remaining_lines"] = lines
         self.new_game_from_data(game_data)
         self.game_state = self.game_engine.len_check()
         self.game_engine.shuffle_with_check()
         return self.game_engine
     
     def progress_game(self, user_input):
-        if self.game_engine.settings["typing_mode"] == False:
-            partial_game_state = self.game_engine.progress_game_simple_mode(user_input)
-        else:
-            partial_game_state = self.game_engine.progress_game_typing_mode(user_input)
-
-
+        mistake_count = self.game_engine.mistake_count
+        with instrumentation.timer("grade"):
+            if self.game_engine.settings.get("multiple_choice", False) == True:
+                partial_game_state = self.game_engine.progress_game_choice_mode(user_input)
+            elif self.game_engine.settings["typing_mode"] == False:
+                partial_game_state = self.game_engine.progress_game_simple_mode(user_input)
+            else:
+                partial_game_state = self.game_engine.progress_game_typing_mode(user_input)
+        instrumentation.count("answers")
+        if self.game_engine.mistake_count != mistake_count:
+            instrumentation.count("mistakes")
+        if self.sessions is not None and self.game_id is not None and self.stored_current:
+            self.sessions.answered(self.game_id, self.game_engine.mistake_count != mistake_count,
+                                   self.game_engine.get_lines_len(),
+                                   self.game_engine.current_line,
+                                   self.game_engine.mistake_count)
 
         # use next batch
         if not partial_game_state:
             #gd = self.game_engine.extract_game_data_from_self()
             self.batch_in_use += 1
-            self.game_engine.remaining_lines = self.game_data_batch_list[self.batch_in_use]
-            self.game_engine.original_lines_len = len(self.game_data_batch_list[self.batch_in_use])
-            self.game_engine.current_line = 0
+            if self.batch_in_use < len(self.game_data_batch_list):
+                self.game_engine.set_lines(self.game_data_batch_list[self.batch_in_use])
+                self.game_engine.current_line = 0
+                if self.sessions is not None and self.game_id is not None:
+                    self.commit_game_on_id(self.game_id)
             #self.game_engine.extract_self_from_game_data(gd)
 
         full_game_state = len(self.game_data_batch_list) > self.batch_in_use
         self.game_state = full_game_state or partial_game_state
 
+        if self.game_state == False and self.history is not None:
+            self.history.record_game(self.game_engine, len(self.game_line_ids),
+                                     self.deck, self.game_line_ids)
+
+        if self.autosaver is not None:
+            if self.game_state == False:
+                self.autosaver.discard()
+            else:
+                self.autosaver.answered(self)
+
+
+    def patch_lines(self, replaced: dict, removed: set, added: list):
+        # Applies a deck reload to the running game. The current batch is
+        # patched in the engine queue and the later ones are rebuilt from
+        # the patched ids. New lines go to the later batches or, when this
+        # is the last batch, to the current one.
+        batches = self.game_data_batch_list
+        later = [batches[i] for i in range(self.batch_in_use + 1, len(batches))]
+        played_len = len(self.game_line_ids) - sum(len(batch) for batch in later)
+        future = [replaced.get(id, id) for batch in later
+                  for id in batch if id not in removed]
+        last = len(later) == 0
+        self.game_engine.patch_lines(replaced, removed, added if last else ())
+        future.extend(() if last else added)
+
+        self.game_line_ids = [replaced.get(id, id)
+                              for id in islice(self.game_line_ids, played_len)
+                              if id not in removed]
+        self.game_line_ids.extend(added if last else ())
+        self.game_line_ids.extend(future)
+        self.game_data_batch_list = BatchView(future, self.game_engine.settings["batch_size"],
+                                              self.batch_in_use + 1)
+        if not self.game_engine.len_check() and not last:
+            self.batch_in_use += 1
+            self.game_engine.set_lines(self.game_data_batch_list[self.batch_in_use])
+            self.game_engine.current_line = 0
+        self.game_state = self.game_engine.len_check()
+        self.stored_current = False
 
     def load_game_with_id(self, id: int):
-        if len(self.past_game_data_list) <= id+2:    #Error here on this check for sure
-            ge = self.new_game_from_data(self.past_game_data_list[id])
-            self.game_state = ge.len_check()
-            ge.shuffle_with_check()
-            self.game_id = id
-        else:
+        # The running game is committed first so switching keeps its progress
+        if self.sessions is None:
+            return None
+        game_data = self.sessions.get(id)
+        if game_data is None:
             return None
+        if self.game_id is not None and self.game_state == True and not self.stored_current:
+            self.commit_game_on_id(self.game_id)
+        self.deck = self.sessions.deck(id)
+        settings = game_data["settings"]
+        # Lines shuffled or split into batches on load are no longer in the
+        # order of the stored copy
+        resumed = game_data.get("queue_state") is not None
+        self.stored_current = settings["random_line_post_batch"] != True and \
+            (resumed or settings["random_line_pre_batch"] != True and
+             settings["batch_mode"] != True)
+        ge = self.new_game_from_data(game_data)
+        self.game_state = ge.len_check()
+        ge.shuffle_with_check()
+        self.game_id = id
+        return ge
         
     def commit_game_auto(self):
+        # A game whose answers were logged to its stored copy has nothing
+        # more to write
         if self.game_id == None:
             self.commit_game_into_data_list()
-        else:
+        elif not self.stored_current:
             self.commit_game_on_id(self.game_id)
 
     def commit_game_on_id(self, id: int):
-        self.past_game_data_list[id] = self.game_engine.extract_game_data_from_self()
+        gd = self.game_engine.extract_game_data_from_self()
+        self.sessions.put(id, gd, self.deck)
+        self.stored_current = True
 
     def commit_game_into_data_list(self):
-        self.past_game_data_list.append(self.game_engine.extract_game_data_from_self())
-
-    def save_game_data_list(self, file_path: str):
+        gd = self.game_engine.extract_game_data_from_self()
+        self.game_id = self.sessions.add(gd, self.deck)
+        self.stored_current = True
+
+    def recover_autosave(self):
+        # Puts a game left in the autosave file, by a crash or by quitting
+        # without saving, into the session store and returns its id
+        if self.autosaver is None or self.sessions is None:
+            return None
+        snapshot = self.autosaver.load()
+        if snapshot is None:
+            return None
+        id = snapshot["id"]
+        if id is None:
+            id = self.sessions.add(snapshot["game"], snapshot["deck"])
+        else:
+            self.sessions.put(id, snapshot["game"], snapshot["deck"])
+            self.sessions.flush()
+        self.autosaver.discard()
+        return id
+
+    @instrumentation.timed("save")
+    def save_game_data_list(self, file_path: str = None):
+        # Commits the current game into the session store, a file path also
+        # gets every saved game written out to it
         self.commit_game_auto()
-        save_game_data_list(self.past_game_data_list, file_path)
+        self.sessions.flush()
+        if self.autosaver is not None:
+            self.autosaver.discard()
+        if file_path == None:
+            return True
+        return save_game_data_list(self.sessions.iter_games(), file_path)
+
+    def close(self):
+        if self.autosaver is not None:
+            if self.game_state == True:
+                self.autosaver.snapshot(self)
+            self.autosaver.wait()
+        if self.sessions is not None:
+            self.sessions.close()
 
 
 ############################# Other
@@ -424,11 +3132,17 @@ def get_score_percent(mistake_count: int, total_len: int, round_to: int = None)
     
     return percent
 
+def clear_screen():
+    with instrumentation.timer("clear_screen"):
+        context.renderer.clear()
+        context.renderer.flush()
+
+@instrumentation.timed("get_info")
 def get_info():
     ret = ""
-    ss = settings["show_score"]
-    sp = settings["show_position"]
-    smc = settings["show_mistake_count"]
+    ss = context.settings["show_score"]
+    sp = context.settings["show_position"]
+    smc = context.settings["show_mistake_count"]
 
     if sp == True:
         adjust = gen.mistake_count if gen.settings["only_once"] == False else 0
@@ -446,19 +3160,628 @@ def get_info():
     ret = None if ret == "" else ret
     return ret
 
-def start_game(folder_path:str, whitelist:list, blacklist:list):
+def load_deck(folder_path:str, whitelist:list, blacklist:list,
+              errors: dict = None) -> LineStore:
+    cache = context.deck_cache if context.settings["deck_cache"] == True else None
+    with instrumentation.timer("load"):
+        lines = load_files_on_dir(folder_path, whitelist, blacklist, cache,
+                                  comment=context.settings["comment"],
+                                  split_=context.settings["split"],
+                                  workers=context.settings["load_workers"],
+                                  errors=errors)
+    if cache is not None:
+        cache.save()
+    context.deck_indexes[lines] = (folder_path, None)
+    # Indexing reads every line, so a compiled deck is only indexed when
+    # it is deduplicated or looked up
+    if context.settings["dedupe"] == True or (context.settings["deck_index"] == True
+                                              and not isinstance(lines, MappedDeck)):
+        deck_index(lines)
+    if context.settings["typing_mode"] == True and not isinstance(lines, MappedDeck):
+        lines.prepare_answers(answer_normalization(context.settings))
+    if context.settings["multiple_choice"] == True:
+        with instrumentation.timer("distractor_index"):
+            distractor_index(lines)
+    return lines
+
+def start_game(folder_path:str, whitelist:list, blacklist:list,
+               errors: dict = None):
     if folder_path == "": raise ValueError("folder_path empty") #huh? why
-    gm.new_game(load_files_on_dir(folder_path, whitelist, blacklist))
+    lines = load_deck(folder_path, whitelist, blacklist, errors)
+    gm.new_game(lines, deck=folder_path, line_ids=unique_line_ids(lines))
     gen = gm.game_engine
     return gen
 
+def deck_index(lines: LineStore) -> DeckIndex:
+    # The index of a deck from load_deck, built on first use
+    folder_path, index = context.deck_indexes[lines]
+    if index is None:
+        index = DeckIndex(answer_normalization(context.settings))
+        with instrumentation.timer("deck_index"):
+            index.add(lines, range(len(lines)))
+        context.deck_indexes[lines] = (folder_path, index)
+    return index
+
+def unique_line_ids(lines: LineStore):
+    # The ids of the first copy of every pair when dedupe is on, None to
+    # play every line
+    if context.settings["dedupe"] == False:
+        return None
+    index = deck_index(lines)
+    if not index.duplicates:
+        return None
+    return [id for id in range(len(lines)) if id not in index.duplicates]
+
+def lookup_term(term: str):
+    # Every line with term on a side, in every deck still in use
+    for lines, (folder_path, _) in list(context.deck_indexes.items()):
+        for id in deck_index(lines).lookup(term):
+            yield folder_path, lines[id]
+
+def reload_game(folder_path:str, whitelist:list, blacklist:list,
+                errors: dict = None) -> bool:
+    # Patches the running game with the deck files changed since they were
+    # read, False when the game has to be started over instead
+    if gm.game_state == False or gm.deck != folder_path:
+        return False
+    cache = context.deck_cache if context.settings["deck_cache"] == True else None
+    with instrumentation.timer("load"):
+        diff = reload_files_on_dir(gm.game_engine.line_store, folder_path,
+                                   whitelist, blacklist, cache,
+                                   comment=context.settings["comment"],
+                                   split_=context.settings["split"],
+                                   errors=errors)
+    if diff is None:
+        return False
+    if cache is not None:
+        cache.save()
+    replaced, removed, added = diff
+    line_store = gm.game_engine.line_store
+    _, index = context.deck_indexes.get(line_store, (None, None))
+    if index is not None:
+        index.remove(line_store, list(removed) + list(replaced))
+        index.add(line_store, added + list(replaced.values()))
+        if context.settings["dedupe"] == True:
+            added = [id for id in added if not index.is_duplicate(id)]
+    distractors = context.distractor_indexes.get(gm.game_engine.line_store)
+    if distractors is not None:
+        distractors.remove(list(removed) + list(replaced))
+        distractors.add(gm.game_engine.line_store, added + list(replaced.values()))
+    gm.patch_lines(replaced, removed, added)
+    return True
+
+
+############################# Simulation
+
+
+class ProbabilisticPolicy:
+    # Answers right with a fixed chance
+    def __init__(self, correct_chance: float = 0.8):
+        self.correct_chance = correct_chance
+
+    def __call__(self, game_engine: GameEngine, turn: int, rng: Random) -> bool:
+        return rng.random() < self.correct_chance
+
+
+class ScriptedPolicy:
+    # Plays a fixed list of right (True) and wrong (False) answers on repeat
+    def __init__(self, answers: List[bool]):
+        if not answers:
+            raise ValueError("a scripted policy needs at least one answer")
+        self.answers = list(answers)
+
+    def __call__(self, game_engine: GameEngine, turn: int, rng: Random) -> bool:
+        return self.answers[turn % len(self.answers)]
+
+
+def simulated_answer(game_engine: GameEngine, correct: bool) -> str:
+    if game_engine.settings["typing_mode"] == False and \
+            game_engine.settings.get("multiple_choice", False) == False:
+        return "" if correct else "x"
+    line = game_engine.get_curent_line()
+    answer = line.side_as_string(line.side_answer, False)
+    return answer if correct else answer + "?"
+
+
+def simulate_session(lines, session_settings: dict, policy, seed: int,
+                     max_answers: int = None) -> dict:
+    # One headless game. The global random module is seeded too, since the
+    # shuffles and side choices of the engine draw from it, and put back the
+    # way it was afterwards.
+    random_state = get_random_state()
+    seed_random(seed)
+    try:
+        rng = Random(seed)
+        game_master = GameMaster(None)
+        game_master.new_game(lines, session_settings)
+        game_engine = game_master.game_engine
+        from_side = SideChoice(session_settings["from_side"])
+        total_len = len(game_master.game_line_ids)
+        if max_answers is None:
+            max_answers = 50 * total_len + 100
+
+        answers = 0
+        while game_master.game_state == True and answers < max_answers:
+            game_engine.get_curent_line().side_answer = \
+                rng.choice([SideChoice.LEFT, SideChoice.RIGHT]) \
+                if from_side == SideChoice.RANDOM else from_side
+            game_master.progress_game(simulated_answer(
+                game_engine, policy(game_engine, answers, rng)))
+            answers += 1
+
+        return {
+            "seed": seed,
+            "answers": answers,
+            "mistakes": game_engine.mistake_count,
+            "finished": game_master.game_state == False,
+            "score": get_score_percent(game_engine.mistake_count, total_len)
+                     if total_len > 0 else 100.0,
+        }
+    finally:
+        set_random_state(random_state)
+
+
+_simulation_job: tuple = None
+
+
+def _init_simulation_worker(lines, session_settings, policy, max_answers):
+    global _simulation_job
+    _simulation_job = (lines, session_settings, policy, max_answers)
+
+
+def _simulate_session_in_worker(seed: int) -> dict:
+    lines, session_settings, policy, max_answers = _simulation_job
+    return simulate_session(lines, session_settings, policy, seed, max_answers)
+
+
+def score_distribution(scores: List[float]) -> dict:
+    if not scores:
+        return {}
+    ordered = sorted(scores)
+
+    def at(percent):
+        return ordered[min(len(ordered) - 1, int(percent / 100 * len(ordered)))]
+
+    buckets = Counter(min(int(score // 10) * 10, 90) for score in ordered)
+    return {
+        "mean": sum(ordered) / len(ordered),
+        "min": ordered[0],
+        "p25": at(25),
+        "median": at(50),
+        "p75": at(75),
+        "max": ordered[-1],
+        # Sessions per 10% wide score range, keyed by the range start
+        "histogram": {str(start): buckets[start] for start in range(0, 100, 10)},
+    }
+
+
+def simulate_sessions(lines, sessions: int, session_settings: dict = None,
+                      policy = None, seed: int = 0, workers: int = 0,
+                      max_answers: int = None) -> dict:
+    # Runs sessions seeded seed, seed + 1, ... and reports throughput and
+    # the spread of the final scores. workers > 1 spreads them on a process
+    # pool, every worker gets the deck once.
+    if session_settings is None:
+        session_settings = context.settings
+    if policy is None:
+        policy = ProbabilisticPolicy()
+    seeds = range(seed, seed + sessions)
+
+    start = perf_counter_ns()
+    if workers > 1 and sessions > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_simulation_worker,
+                                 initargs=(lines, session_settings, policy,
+                                           max_answers)) as executor:
+            results = list(executor.map(_simulate_session_in_worker, seeds,
+                                        chunksize=max(1, sessions // (workers * 4))))
+    else:
+        results = [simulate_session(lines, session_settings, policy, session_seed,
+                                    max_answers) for session_seed in seeds]
+    seconds = (perf_counter_ns() - start) / 10**9
+
+    answers = sum(result["answers"] for result in results)
+    return {
+        "sessions": sessions,
+        "answers": answers,
+        "unfinished": sum(1 for result in results if not result["finished"]),
+        "seconds": seconds,
+        "sessions_per_second": sessions / seconds if seconds > 0 else 0.0,
+        "answers_per_second": answers / seconds if seconds > 0 else 0.0,
+        "scores": score_distribution([result["score"] for result in results]),
+    }
+
+
+############################# Server
+
+
+SERVER_MAX_LINE = 4096
+
+SERVER_HELP = """Commands:
+game folder_path [-w file_name] [-b file_name]  start a game
+quit                                            disconnect
+While in a game every line is an answer, :stop ends the game.
+"""
+
+
+class DeckRegistry:
+    # One parsed copy of every deck in use, shared by all the sessions playing
+    # it. get() counts a user of the deck and release() drops one, a deck
+    # nobody uses is kept among the last `idle_decks` such decks and then
+    # dropped. Loads run one at a time off the event loop, they share the
+    # deck cache. The lines a game plays are picked once per deck there too.
+    def __init__(self, deck_root: str = None, idle_decks: int = 4):
+        self.deck_root = None if deck_root is None else abspath(deck_root)
+        self.idle_decks = idle_decks
+        self.decks = {}
+        self.users = Counter()
+        # Keys of loaded decks without users, oldest first
+        self.idle = OrderedDict()
+        self.loading = None
+
+    def resolve(self, folder_path: str) -> str:
+        if self.deck_root is None:
+            return folder_path
+        resolved = abspath(join(self.deck_root, folder_path))
+        if resolved != self.deck_root and \
+                not resolved.startswith(join(self.deck_root, "")):
+            raise ValueError(f"{folder_path} is outside the deck folder")
+        return resolved
+
+    async def get(self, folder_path: str, whitelist = (), blacklist = ()):
+        # (key, lines, errors, line ids for new_game), the key is what
+        # release() takes
+        import asyncio
+
+        folder_path = self.resolve(folder_path)
+        key = (abspath(folder_path), tuple(whitelist), tuple(blacklist))
+        if self.loading is None:
+            self.loading = asyncio.Lock()
+        async with self.loading:
+            if key not in self.decks:
+                errors = {}
+                loop = asyncio.get_running_loop()
+                lines = await loop.run_in_executor(
+                    None, load_deck, folder_path, list(whitelist),
+                    list(blacklist), errors)
+                line_ids = await loop.run_in_executor(None, unique_line_ids, lines)
+                self.decks[key] = (lines, errors, line_ids)
+            self.users[key] += 1
+            self.idle.pop(key, None)
+        return (key, *self.decks[key])
+
+    def release(self, key: tuple):
+        self.users[key] -= 1
+        if self.users[key] > 0:
+            return
+        del self.users[key]
+        self.idle[key] = True
+        while len(self.idle) > self.idle_decks:
+            del self.decks[self.idle.popitem(last=False)[0]]
+
+
+class ServerSession:
+    # What one connection owns: its game, its queue and counters inside the
+    # engine, and the side it is answering. The deck itself is shared.
+    __slots__ = ("game_master", "deck_key", "side_answer", "revealed", "options")
+
+    def __init__(self):
+        # Finished games are recorded by the server, off the event loop
+        self.game_master = GameMaster(None)
+        # Registry key of the deck played, released when the session is done
+        self.deck_key: tuple = None
+        self.side_answer: SideChoice = None
+        self.revealed = False
+        # Options of the line shown in multiple choice mode
+        self.options: List[str] = None
+
+
+class GameServer:
+    # Line based TCP server, every connection is one coroutine and one
+    # ServerSession, so idle sessions cost a socket and their queue
+    def __init__(self, decks: DeckRegistry = None, history: GameHistory = None,
+                 max_sessions: int = 10000, idle_timeout: float = None):
+        self.decks = DeckRegistry() if decks is None else decks
+        self.history = history
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = 0
+        self._history_executor = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8765):
+        import asyncio
+
+        return await asyncio.start_server(self.handle, host, port,
+                                          limit=SERVER_MAX_LINE)
+
+    async def serve_forever(self, host: str = "127.0.0.1", port: int = 8765):
+        server = await self.start(host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader: "asyncio.StreamReader",
+                     writer: "asyncio.StreamWriter"):
+        import asyncio
+
+        if self.sessions >= self.max_sessions:
+            writer.write(b"Server is full\n")
+            writer.close()
+            return
+        self.sessions += 1
+        session = ServerSession()
+        try:
+            writer.write(("Type help for commands\n" + self.prompt(session)).encode())
+            while True:
+                await writer.drain()
+                try:
+                    raw = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                except (asyncio.TimeoutError, ValueError):
+                    # Idle for too long or a line over SERVER_MAX_LINE
+                    break
+                if not raw:
+                    break
+                reply = await self.handle_line(
+                    session, raw.decode("utf-8", "replace").rstrip("\r\n"))
+                if reply is None:
+                    break
+                if not session.revealed:
+                    reply += self.prompt(session)
+                writer.write(reply.encode())
+        except ConnectionError:
+            pass
+        finally:
+            self.sessions -= 1
+            if session.deck_key is not None:
+                self.decks.release(session.deck_key)
+            writer.close()
+
+    async def handle_line(self, session: ServerSession, text: str):
+        # Returns the reply, None closes the connection
+        if session.game_master.game_state == True:
+            if text.strip() == ":stop":
+                session.game_master.game_state = False
+                session.revealed = False
+                return "Game stopped\n"
+            return await self.answer(session, text)
+
+        try:
+            args = shlex.split(text)
+        except ValueError as e:
+            return f"{e}\n"
+        if not args:
+            return ""
+        if args[0] == "quit":
+            return None
+        if args[0] == "help":
+            return SERVER_HELP
+        if args[0] == "game" and len(args) > 1:
+            whitelist, blacklist = [], []
+            options = iter(args[2:])
+            for option in options:
+                if option in ("-w", "--whitelist"):
+                    whitelist.append(next(options, ""))
+                elif option in ("-b", "--blacklist"):
+                    blacklist.append(next(options, ""))
+                else:
+                    return f"Unknown option {option}\n"
+            try:
+                key, lines, errors, line_ids = \
+                    await self.decks.get(args[1], whitelist, blacklist)
+            except (OSError, ValueError) as e:
+                return f"{e}\n"
+            if session.deck_key is not None:
+                self.decks.release(session.deck_key)
+            session.deck_key = key
+            session.game_master.new_game(lines, context.settings, args[1], line_ids)
+            reply = "".join(f"Skipped {file_name}: {error}\n"
+                            for file_name, error in errors.items())
+            if session.game_master.game_state == False:
+                reply += "No lines to play\n"
+            return reply
+        return f"Unknown command {args[0]}, type help for commands\n"
+
+    def prompt(self, session: ServerSession) -> str:
+        game_master = session.game_master
+        if game_master.game_state == False:
+            return "> "
+        game_engine = game_master.game_engine
+        # The side lives with the session, the side stored in the shared deck
+        # is only set right before grading
+        session.side_answer = side_random_handle(
+            SideChoice(game_engine.settings["from_side"]))
+        side_show = SideChoice.RIGHT if session.side_answer == SideChoice.LEFT \
+            else SideChoice.LEFT
+        line = game_engine.get_curent_line()
+        game_engine.line_shown()
+        if game_engine.settings.get("multiple_choice", False) == True:
+            session.options = distractor_index(game_engine.line_store).options(
+                game_engine.line_store, game_engine.remaining_lines[0],
+                session.side_answer, game_engine.settings["distractor_count"],
+                answer_normalization(game_engine.settings))
+            return line.side_as_string(side_show, False) + "\n" + "".join(
+                f"{number}) {option}\n" for number, option in
+                enumerate(session.options, start=1)) + "> "
+        if game_engine.settings["typing_mode"] == False:
+            return line.side_as_string(side_show)
+        return line.side_as_string(side_show, False) + context.settings["split"]
+
+    async def record_game(self, game_master: GameMaster):
+        # The sqlite insert runs on one history thread, so a finished game
+        # does not stall the other sessions and writes never overlap
+        import asyncio
+
+        if self._history_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._history_executor = ThreadPoolExecutor(1, thread_name_prefix="history")
+        await asyncio.get_running_loop().run_in_executor(
+            self._history_executor, self.history.record_game, game_master.game_engine,
+            len(game_master.game_line_ids), game_master.deck, game_master.game_line_ids)
+
+    async def answer(self, session: ServerSession, text: str) -> str:
+        game_master = session.game_master
+        game_engine = game_master.game_engine
+        line = game_engine.get_curent_line()
+        # Multiple choice is graded like typing mode, without a reveal
+        typing_mode = game_engine.settings["typing_mode"] or \
+            game_engine.settings.get("multiple_choice", False)
+        if session.options is not None:
+            if text.strip().isdigit() and 1 <= int(text) <= len(session.options):
+                text = session.options[int(text) - 1]
+            session.options = None
+        if typing_mode == False and not session.revealed:
+            session.revealed = True
+            return f"{line}\n"
+        session.revealed = False
+
+        # Nothing is awaited between setting the side and grading, so no
+        # other session can change it in between
+        line.side_answer = session.side_answer
+        mistake_count = game_engine.mistake_count
+        reply = f"{line}\n" if typing_mode == True else ""
+        game_master.progress_game(text)
+        if typing_mode == True:
+            reply += "Wrong\n" if game_engine.mistake_count != mistake_count \
+                else "Right\n"
+        if game_master.game_state == False:
+            if self.history is not None:
+                await self.record_game(game_master)
+            score = get_score_percent(game_engine.mistake_count,
+                                      len(game_master.game_line_ids), 2)
+            reply += f"Game over - {game_engine.mistake_count} mistakes - {score}%\n"
+        return reply
+
+
+############################# Prompt pipeline
+
+
+class PreparedPrompt:
+    # What the game loop draws for one line, made before the line comes up
+    __slots__ = ("line_id", "side_answer", "shown", "revealed", "options")
+
+    def __init__(self, line_id: int, side_answer: SideChoice, shown: str,
+                 revealed: str, options: List[str] = None):
+        self.line_id = line_id
+        self.side_answer = side_answer
+        self.shown = shown
+        self.revealed = revealed
+        # Multiple choice options, None in the other modes
+        self.options = options
+
+
+def prepare_prompt(game_engine: GameEngine, line_id: int) -> PreparedPrompt:
+    # Picks the side and formats the line. Also normalizes the answer the
+    # grading will compare against, so that is cached by the time it runs.
+    settings = game_engine.settings
+    line_store = game_engine.line_store
+    side_answer = side_random_handle(SideChoice(settings["from_side"]))
+    side_show = SideChoice.RIGHT if side_answer == SideChoice.LEFT else SideChoice.LEFT
+    line = line_store[line_id]
+    options = None
+    if settings.get("multiple_choice", False) == True:
+        options = distractor_index(line_store).options(
+            line_store, line_id, side_answer, settings["distractor_count"],
+            answer_normalization(settings))
+        shown = line.side_as_string(side_show, False)
+    elif settings["typing_mode"] == False:
+        shown = line.side_as_string(side_show)
+    else:
+        shown = line.side_as_string(side_show, False) + context.settings["split"]
+    if settings["typing_mode"] == True or options is not None:
+        line_store.normalized_answer(line_id, side_answer, answer_normalization(settings))
+    return PreparedPrompt(line_id, side_answer, shown, str(line), options)
+
+
+class PromptPipeline:
+    # Makes the prompts of the next `depth` lines on a worker thread while
+    # the player answers the current one. Prompts are kept per line id and
+    # used once. The front line takes its prompt or has one made on the
+    # spot, and prompts of lines no longer coming up are dropped, whether a
+    # mistake requeued something, the queue was shuffled or the deck was
+    # reloaded. A requeued line is never shown with its old side again.
+    # Only one job runs at a time and prepared is only touched by the game
+    # loop after wait(), the worker never reads the queue.
+    def __init__(self, depth: int = 4):
+        self.depth = depth
+        self.prepared: dict = {}
+        self._game_engine: GameEngine = None
+        self._line_store = None
+        self._job = None
+        self._executor = None
+
+    def _follow(self, game_engine: GameEngine):
+        # A new or loaded game, or a reload into another store, starts over
+        if game_engine is not self._game_engine or \
+                game_engine.line_store is not self._line_store:
+            self.wait()
+            self.prepared = {}
+            self._game_engine = game_engine
+            self._line_store = game_engine.line_store
+
+    def wait(self):
+        # Called before anything that changes the deck, and by next()
+        if self._job is None:
+            return
+        try:
+            self._job.result()
+        except Exception as e:
+            # Made again on the spot, where a real problem shows up
+            self.prepared = {}
+        self._job = None
+
+    def next(self, game_engine: GameEngine) -> PreparedPrompt:
+        # The prompt of the front line, with its side set on the line
+        self._follow(game_engine)
+        self.wait()
+        line_id = game_engine.remaining_lines[0]
+        prompt = self.prepared.pop(line_id, None)
+        if prompt is None:
+            instrumentation.count("prompt_misses")
+            prompt = prepare_prompt(game_engine, line_id)
+        else:
+            instrumentation.count("prompt_hits")
+        game_engine.line_store[line_id].side_answer = prompt.side_answer
+        return prompt
+
+    def prefetch(self, game_engine: GameEngine):
+        # Called once the front line is on screen
+        if self.depth <= 0:
+            return
+        self._follow(game_engine)
+        self.wait()
+        upcoming = game_engine.remaining_lines.peek(self.depth + 1)[1:]
+        self.prepared = {line_id: prompt for line_id, prompt in self.prepared.items()
+                         if line_id in upcoming}
+        missing = [line_id for line_id in dict.fromkeys(upcoming)
+                   if line_id not in self.prepared]
+        if not missing:
+            return
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(1, thread_name_prefix="prompts")
+        self._job = self._executor.submit(self._prepare, game_engine, missing)
+
+    def _prepare(self, game_engine: GameEngine, line_ids: List[int]):
+        for line_id in line_ids:
+            self.prepared[line_id] = prepare_prompt(game_engine, line_id)
+
+    def close(self):
+        self.wait()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
 
 ############################# Game loop
 
 
 if __name__ == "__main__":
     import click
-    import shlex
+
+    def echo_load_errors(errors: dict):
+        for file_name, error in errors.items():
+            click.echo(f"Skipped {file_name}: {error}")
 
     @click.group()
     def cli():
@@ -490,15 +3813,15 @@ if __name__ == "__main__":
         also options are not mandatory but folder_path is\n
         \n
         example:\n
-        game C:\Learning -w text.txt \n
+        game C:\\Learning -w text.txt \n
         \n
         if you want more than one whitelisted file do:\n
-        game C:\Learning -w text_1.txt -w text_2.txt -w text_3.txt\n
+        game C:\\Learning -w text_1.txt -w text_2.txt -w text_3.txt\n
         \n
         this also works but is a little pointless:\n
-        game C:\Learning -w text_1.txt -w text_2.txt -b text_3.txt"""
+        game C:\\Learning -w text_1.txt -w text_2.txt -b text_3.txt"""
 
-        if settings["no_cls"] == False: system("cls")
+        clear_screen()
 
         global gen, show_cmd, restart_folder_path,\
         restart_whitelist, restart_blacklist
@@ -507,34 +3830,278 @@ if __name__ == "__main__":
         restart_whitelist = whitelist
         restart_blacklist = blacklist
 
-        gen = start_game(folder_path, whitelist, blacklist)
+        load_errors = {}
+        gen = start_game(folder_path, whitelist, blacklist, load_errors)
+        echo_load_errors(load_errors)
         show_cmd = False
 
+    @cli.command(name='compile')
+    @click.argument('folder_path', type=str, required=True)
+    @click.argument('output_path', type=str, required=True)
+    @click.option('-w', '--whitelist', type=str, multiple=True, default=[])
+    @click.option('-b', '--blacklist', type=str, multiple=True, default=[])
+    def compile_(folder_path, output_path, whitelist, blacklist):
+        """Compile deck files into one .wgd deck.\n
+        compile C:\\Learning C:\\Compiled\\learning.wgd\n
+        \n
+        A folder holding only one compiled deck is opened without reading\n
+        it into memory, use this for very large decks."""
+        load_errors = {}
+        lines = load_files_on_dir(folder_path, whitelist, blacklist,
+                                  comment=context.settings["comment"],
+                                  split_=context.settings["split"],
+                                  workers=context.settings["load_workers"],
+                                  errors=load_errors)
+        echo_load_errors(load_errors)
+        compile_deck(lines, output_path)
+        click.echo(f"Compiled {len(lines)} lines into {output_path}")
+
+    @cli.command()
+    @click.argument('word', type=str, required=True)
+    def lookup(word):
+        """Find a word in every deck still in use by a game.\n
+        lookup dog\n
+        shows every line with dog on either side, with its file and line.\n
+        Use quotes for more than one word: lookup 'hot dog'"""
+        found = 0
+        for folder_path, line in lookup_term(word):
+            click.echo(f"{line} ({join(folder_path, line.file or '')}:{line.index})")
+            found += 1
+        click.echo(f"{found} found")
+
+    @cli.command()
+    @click.argument('folder_path', type=str, required=True)
+    @click.option('-s', '--sessions', type=int, default=1000)
+    @click.option('-p', '--correct-chance', type=float, default=0.8)
+    @click.option('--script', type=str, default=None)
+    @click.option('--seed', type=int, default=0)
+    @click.option('--workers', type=int, default=0)
+    @click.option('-w', '--whitelist', type=str, multiple=True, default=[])
+    @click.option('-b', '--blacklist', type=str, multiple=True, default=[])
+    @click.option('-o', '--output', type=str, default=None)
+    def simulate(folder_path, sessions, correct_chance, script, seed, workers,
+                 whitelist, blacklist, output):
+        """Play many games without a player, using the current settings.\n
+        simulate C:\\Learning -s 5000 -p 0.7\n
+        answers right 70% of the time in 5000 games\n
+        \n
+        simulate C:\\Learning --script 110\n
+        answers right, right, wrong and then repeats that\n
+        \n
+        --seed sets the first seed, every game gets the next one\n
+        --workers 4 plays the games on 4 processes\n
+        -o writes the full report as json to a file"""
+        load_errors = {}
+        lines = load_deck(folder_path, whitelist, blacklist, load_errors)
+        echo_load_errors(load_errors)
+        policy = ScriptedPolicy([answer == "1" for answer in script]) \
+            if script is not None else ProbabilisticPolicy(correct_chance)
+        report = simulate_sessions(lines, sessions, context.settings, policy, seed, workers)
+
+        scores = report["scores"]
+        click.echo(f"{report['sessions']} games, {report['answers']} answers "
+                   f"in {round(report['seconds'], 2)}s")
+        click.echo(f"{round(report['sessions_per_second'], 2)} games/s, "
+                   f"{round(report['answers_per_second'], 2)} answers/s")
+        if report["unfinished"] > 0:
+            click.echo(f"{report['unfinished']} games hit the answer limit")
+        if scores:
+            click.echo(f"score mean {round(scores['mean'], 2)}% - min {round(scores['min'], 2)}% "
+                       f"- median {round(scores['median'], 2)}% - max {round(scores['max'], 2)}%")
+            for start, count in scores["histogram"].items():
+                click.echo(f"{start:>3}%+ {count}")
+        if output is not None:
+            with open(output, 'w') as f:
+                json.dump(report, f, indent=4)
+
+    @cli.command()
+    @click.option('-h', '--host', type=str, default="127.0.0.1")
+    @click.option('-p', '--port', type=int, default=8765)
+    @click.option('-d', '--deck-root', type=str, default=None)
+    @click.option('--max-sessions', type=int, default=10000)
+    @click.option('--idle-timeout', type=float, default=None)
+    def serve(host, port, deck_root, max_sessions, idle_timeout):
+        """Host games for many players over TCP, until Ctrl+C.\n
+        serve -p 8765 -d C:\\Learning\n
+        \n
+        Connect with any line based client, for example:\n
+        nc 127.0.0.1 8765\n
+        and type help there.\n
+        \n
+        -d only lets players open decks inside that folder,\n
+        --idle-timeout disconnects players idle for that many seconds"""
+        server = GameServer(DeckRegistry(deck_root), context.game_history,
+                            max_sessions, idle_timeout)
+        click.echo(f"Serving on {host}:{port}")
+        import asyncio
+
+        try:
+            asyncio.run(server.serve_forever(host, port))
+        except KeyboardInterrupt:
+            click.echo("Server stopped")
+
     @cli.command()
     @click.argument('id', type=str, default='0')
     def load(id):
-        """Load a game, does not work yet."""
+        """Load a saved game, saves lists their ids.\n
+        load 3\n
+        the game being played is saved first if it was saved before"""
+        global gen, show_cmd
         click.echo(f"Loading game with ID: {id}")
-        gm.load_game_with_id(int(id))
+        try:
+            game_engine = gm.load_game_with_id(int(id))
+        except (OSError, ValueError) as e:
+            # The deck the game was saved on is gone or was recompiled
+            click.echo(f"Could not load: {e}")
+            return
+        if game_engine is None:
+            click.echo(f"There is no saved game with ID: {id}")
+            return
+        gen = gm.game_engine
+        show_cmd = False
 
     @cli.command()
-    @click.argument('file_path', type=str, default='game_history.json')
+    @click.argument('file_path', type=str, default=None, required=False)
     def save(file_path):
-        """Save the game, does not work yet."""
-        click.echo(f"Saving game to {file_path}")
-        gm.save_game_data_list(file_path)
+        """Save the game.\n
+        save\n
+        saves the game being played, a new game gets a new ID\n
+        \n
+        save C:\\Saves\\games.sav\n
+        also writes every saved game to that file, as json if it ends in .json"""
+        if gen == None:
+            click.echo("There is no game to save")
+            return
+        try:
+            gm.save_game_data_list(file_path)
+        except (OSError, ValueError) as e:
+            click.echo(f"Could not save: {e}")
+            return
+        click.echo(f"Saved game with ID: {gm.game_id}")
+        if file_path is not None:
+            click.echo(f"Saved every game to {file_path}")
 
     @cli.command()
-    def history():
-        """Show game history, does not work yet."""
-        click.echo("Showing game history.")
+    @click.option('-p', '--page', type=int, default=1)
+    @click.option('-n', '--per-page', type=int, default=10)
+    def saves(page, per_page):
+        """List saved games, newest first.\n
+        saves -p 2 shows the next page and -n sets how many are on a page"""
+        total = gm.sessions.count()
+        pages = max(1, -(-total // per_page))
+        click.echo(f"Page {page}/{pages} - {total} saved games")
+        for id, saved_at, deck, remaining, current_line, mistake_count in \
+                gm.sessions.list_saves(page - 1, per_page):
+            click.echo(f"{id}: {saved_at} - {deck} - {current_line} answered - "
+                       f"{remaining} left - {mistake_count} mistakes")
 
     @cli.command()
-    def restart():
-        """Restart the game reloading it from last used game files"""
-        if settings["no_cls"] == False: system("cls")
+    @click.option('-p', '--page', type=int, default=1)
+    @click.option('-n', '--per-page', type=int, default=10)
+    @click.option('-d', '--deck', type=str, default=None)
+    @click.option('--decks', is_flag=True, default=False)
+    @click.option('--hardest', type=int, default=0)
+    def history(page, per_page, deck, decks, hardest):
+        """Show game history.\n
+        history\n
+        shows the newest finished games, -p 2 shows the next page\n
+        and -n sets how many games are on a page\n
+        \n
+        history -d C:\\Learning\n
+        only shows games played from that folder, with --hardest\n
+        only its lines\n
+        \n
+        history --decks\n
+        shows the game count, scores and score trend for every folder\n
+        \n
+        history --hardest 20\n
+        shows the 20 lines with the highest mistake rate over every game"""
+        # Both summaries are computed with numpy, without it they come
+        # straight from sqlite and leave out the trend and answer times
+        if decks:
+            try:
+                for deck_, games, average, recent, trend in context.line_stats.score_trend():
+                    click.echo(f"{deck_} - {games} games - average {round(average, 2)}% "
+                               f"- last {min(games, 5)} {round(recent, 2)}% "
+                               f"- {trend:+.2f}% per game")
+            except ImportError:
+                for deck_, games, average, best, last in context.game_history.deck_summary():
+                    click.echo(f"{deck_} - {games} games - average {round(average, 2)}% "
+                               f"- best {round(best, 2)}% - last {last}")
+            return
+
+        if hardest > 0:
+            try:
+                lines = context.line_stats.hardest(hardest, deck)
+            except ImportError:
+                lines = [line + (None,) for line in
+                         context.game_history.hardest_lines(hardest, deck)]
+            for deck_, file, index, left, right, attempts, mistakes, latency_ms in lines:
+                info = f"{left} - {right} ({file}:{index} in {deck_}) - " \
+                       f"{mistakes} mistakes in {attempts} answers"
+                if latency_ms is not None:
+                    info += f" - {latency_ms / 1000:.1f}s per answer"
+                click.echo(info)
+            return
+
+        total = context.game_history.count_games(deck)
+        pages = max(1, -(-total // per_page))
+        click.echo(f"Page {page}/{pages} - {total} games")
+        for id, finished_at, deck_, lines_len, mistake_count, score in \
+                context.game_history.list_games(page - 1, per_page, deck):
+            click.echo(f"{id}: {finished_at} - {deck_} - {lines_len} lines - "
+                       f"{mistake_count} mistakes - {round(score, 2)}%")
+
+    @cli.command()
+    @click.option('-o', '--output', type=str, default=None)
+    @click.option('--reset', is_flag=True, default=False)
+    @click.option('--on/--off', 'enable', default=None)
+    def stats(output, reset, enable):
+        """Show timings of the game phases.\n
+        stats\n
+        shows p50/p95/p99 latencies of every phase and the counters\n
+        \n
+        stats --on / stats --off\n
+        turns collecting on or off, the instrumentation setting does it\n
+        for every start\n
+        \n
+        stats -o stats.json\n
+        also writes them to a file, --reset clears them afterwards"""
+        if enable is not None:
+            instrumentation.enabled = enable
+        summary = instrumentation.summary()
+        if not instrumentation.enabled:
+            click.echo("Instrumentation is off, use stats --on to collect timings")
+        for phase, phase_summary in summary["phases"].items():
+            click.echo(f"{phase}: {phase_summary['count']} - "
+                       f"p50 {phase_summary['p50_ms']:.3f}ms - "
+                       f"p95 {phase_summary['p95_ms']:.3f}ms - "
+                       f"p99 {phase_summary['p99_ms']:.3f}ms - "
+                       f"max {phase_summary['max_ms']:.3f}ms")
+        for counter, value in summary["counters"].items():
+            click.echo(f"{counter}: {value}")
+        if output is not None:
+            try:
+                save_data_to_json(summary, output)
+            except OSError as e:
+                click.echo(f"Could not write {output}: {e}")
+        if reset:
+            instrumentation.reset()
+
+    @cli.command()
+    @click.option('--full', is_flag=True, default=False)
+    def restart(full):
+        """Reload the last used game files and keep playing.\n
+        Only files changed since they were read are read again, the game\n
+        keeps its position and mistakes. restart --full starts it over."""
+        clear_screen()
         global gen, show_cmd
-        gen = start_game(restart_folder_path, restart_whitelist, restart_blacklist)
+        load_errors = {}
+        if full or not reload_game(restart_folder_path, restart_whitelist,
+                                   restart_blacklist, load_errors):
+            gen = start_game(restart_folder_path, restart_whitelist,
+                             restart_blacklist, load_errors)
+        echo_load_errors(load_errors)
         gen = gm.game_engine
         show_cmd = False
         
@@ -566,71 +4133,111 @@ if __name__ == "__main__":
     restart_whitelist = []
     restart_blacklist = []
 
-    gm = GameMaster(DEFAULT_GAME_SAVES_PATH)
+    gm = GameMaster(DEFAULT_GAME_SAVES_PATH, context.game_history,
+                    context.settings["session_cache_size"],
+                    Autosaver(DEFAULT_AUTOSAVE_PATH,
+                              context.settings["autosave_answers"],
+                              context.settings["autosave_seconds"]))
+    recovered_id = gm.recover_autosave()
+    if recovered_id is not None:
+        print(f"Recovered the last game from its autosave, load {recovered_id} to continue it")
+
+    renderer = context.renderer
+    prompts = PromptPipeline(context.settings["prefetch_prompts"])
 
-    while game_is_running == True:
-        if show_cmd == True or gm.game_state == False:
+    # A game cut short by an error or Ctrl+C still gets its last snapshot
+    try:
+        while game_is_running == True:
+            if show_cmd == True or gm.game_state == False:
+                # Commands may load or reload a deck the worker is reading
+                prompts.wait()
             
-            if gen != None and gen.current_line > 0:
-                print(f"Info: {get_info()}")
-            user_input: str = input("Enter command: ")
-            if user_input.startswith("help"):
-                user_input = user_input[4:] + " --help"
-            user_input = shlex.split(user_input)
-            if settings["no_cls"] == False: system("cls") 
-            if game_loop_supress_error:
-                cli(user_input, standalone_mode=False)
-            try:
-                if not game_loop_supress_error:
+                if gen != None and gen.current_line > 0:
+                    renderer.write(f"Info: {get_info()}\n")
+                for error in gm.autosaver.pop_errors():
+                    renderer.write(f"Autosave failed: {error}\n")
+                renderer.write("Enter command: ")
+                renderer.flush()
+                user_input: str = input()
+                if user_input.startswith("help"):
+                    user_input = user_input[4:] + " --help"
+                user_input = shlex.split(user_input)
+                clear_screen()
+                if game_loop_supress_error:
                     cli(user_input, standalone_mode=False)
-            except Exception as e:
-                print(e)
-            if ("game" not in user_input) and \
-                ("continue" not in user_input) and \
-                ("restart" not in user_input): print()
+                try:
+                    if not game_loop_supress_error:
+                        cli(user_input, standalone_mode=False)
+                except Exception as e:
+                    print(e)
+                if ("game" not in user_input) and \
+                    ("continue" not in user_input) and \
+                    ("restart" not in user_input): print()
             
 
-        elif gm.game_state == True and show_cmd == False:
-            gi = get_info()
-            if gi != None:
-                print(f"Info: {gi}")
-
-            # Doing this to make it easier to acces options
-            # since options won't change while in the game
-            from_side = SideChoice(gen.settings["from_side"])
-            typing_mode = gen.settings["typing_mode"]
-            split = settings["split"]
-
-            side_answer = side_random_handle(from_side)
-            line_current = gen.get_curent_line()
-            line_current.side_answer = side_answer
-
-            if side_answer == SideChoice.LEFT:
-                side_show = SideChoice.RIGHT
-            else: side_show = SideChoice.LEFT
-
-            if typing_mode == False:
-                print(line_current.side_as_string(side_show), end = "")
-                input()
-                print(line_current)
-                inp = input()
-                if ":cmd" in inp:
-                    show_cmd = True
-                    inp = inp.replace(":cmd", "")
-                    if settings["no_cls"] == False: system("cls")
-
-            else:   # typing mode == True
-                print(gen.get_curent_line().side_as_string(side_show, False)
-                      + settings["split"], end = "")
-                inp = input()
-                print(gen.get_curent_line())
-                cmd_ = input()
-                if cmd_ == ":cmd":
-                    show_cmd = True
-                    if settings["no_cls"] == False: system("cls")
-
-            gm.progress_game(inp)
-            if settings["no_cls"] == False: system("cls")
+            elif gm.game_state == True and show_cmd == False:
+                gi = get_info()
+                renderer.row(1, f"Info: {gi}" if gi != None else "")
+
+                # The side and text of the line were made while the last
+                # one was answered, the next ones are made during this one
+                prompt = prompts.next(gen)
+                typing_mode = gen.settings["typing_mode"]
+
+                if prompt.options is not None:
+                    options = prompt.options
+                    renderer.row(2, prompt.shown)
+                    for number, option in enumerate(options, start=1):
+                        renderer.row(2 + number, f"{number}) {option}")
+                    renderer.prompt(3 + len(options), "> ")
+                    renderer.flush()
+                    gen.line_shown()
+                    prompts.prefetch(gen)
+                    inp = input()
+                    # The number of an option or its text
+                    if inp.strip().isdigit() and 1 <= int(inp) <= len(options):
+                        inp = options[int(inp) - 1]
+                    renderer.write(f"{prompt.revealed}\n")
+                    renderer.flush()
+                    cmd_ = input()
+                    if cmd_ == ":cmd":
+                        show_cmd = True
+                        clear_screen()
+
+                elif typing_mode == False:
+                    renderer.prompt(2, prompt.shown)
+                    renderer.flush()
+                    gen.line_shown()
+                    prompts.prefetch(gen)
+                    input()
+                    renderer.write(f"{prompt.revealed}\n")
+                    renderer.flush()
+                    inp = input()
+                    if ":cmd" in inp:
+                        show_cmd = True
+                        inp = inp.replace(":cmd", "")
+                        clear_screen()
+
+                else:   # typing mode == True
+                    renderer.prompt(2, prompt.shown)
+                    renderer.flush()
+                    gen.line_shown()
+                    prompts.prefetch(gen)
+                    inp = input()
+                    renderer.write(f"{prompt.revealed}\n")
+                    renderer.flush()
+                    cmd_ = input()
+                    if cmd_ == ":cmd":
+                        show_cmd = True
+                        clear_screen()
+
+                gm.progress_game(inp)
+                # Mid game the next frame redraws over this one
+                if gm.game_state == False:
+                    clear_screen()
+    finally:
+        prompts.close()
+        gm.close()
             
 
 ############################# TODO: